@@ -1,78 +1,990 @@
 #!/usr/bin/env python
 
+import argparse
+import base64
+import collections
+import contextlib
 import csv
 import email
+import email.header
 import functools
+import gzip
+import hashlib
+import io
+import json
 import os
+import pickle
+import queue
+import quopri
 import random
 import re
+import resource
+import select
+import shutil
+import socket
+import sqlite3
+import statistics
+import struct
+import subprocess
 import sys
+import tempfile
 import textwrap
+import threading
 import time
 import urllib
 
-import discord
-import feedparser
-import gspread
-import puz
 import requests
-import yagmail
-import yaml
-import xmltodict
 
-import xword_dl
+# the rest of the third-party dependencies are imported where they're used,
+# so that each kind of run only loads what it needs: a dry run never loads
+# yagmail, only the xword-dl workers load xword_dl, and tools that just
+# render templates load neither gspread nor the IMAP client
 
-from bs4 import BeautifulSoup
-from imapclient import IMAPClient
 from requests.adapters import HTTPAdapter
-from titlecase import titlecase
+from requests.structures import CaseInsensitiveDict
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
+from html.parser import HTMLParser
 from urllib3.util import Retry
+from xml.etree import ElementTree
 from zipfile import ZipFile, is_zipfile
 
-requests.get = functools.partial(requests.get, headers={'User-Agent':'Automatt'}, timeout=10)
-requests.head = functools.partial(requests.head, headers={'User-Agent':'Automatt'}, timeout=10)
+class HostThrottle:
+    def __init__(self, per_host=2, interval=1.0):
+        self.per_host = per_host
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.semaphores = {}
+        self.next_slot = {}
+
+    @contextlib.contextmanager
+    def __call__(self, url):
+        host = urllib.parse.urlsplit(url).hostname or ''
+
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.per_host)
+            semaphore = self.semaphores[host]
+
+        with semaphore:
+            with self.lock:
+                now = time.monotonic()
+                slot = max(now, self.next_slot.get(host, now))
+                self.next_slot[host] = slot + self.interval
+            time.sleep(slot - now)
+            yield
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+RUN_DATE = datetime.today()
+# where the day's puzzles are saved; site threads that were given up on
+# can still be running when the cwd moves on, so they're given this instead
+DAY_DIR = '.'
+WORKER_ID = '{}-{}'.format(socket.gethostname(), os.getpid())
+
+def write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def day_path(filename):
+    return os.path.join(DAY_DIR, filename)
+
+class JSONState:
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.RLock()
+        self.data = {}
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def load(self, path):
+        with self.lock:
+            self.path = path
+            self.data = self.read()
+
+    def get(self, key, default=None):
+        with self.lock:
+            return self.data.get(key, default)
+
+    def set(self, key, value):
+        with self.lock:
+            if self.path:
+                # pick up whatever another process saved in the meantime
+                self.data.update(self.read())
+            self.data[key] = value
+            if self.path:
+                write_atomic(self.path, json.dumps(self.data).encode())
+
+    def update(self, values):
+        with self.lock:
+            if self.path:
+                self.data.update(self.read())
+            self.data.update(values)
+            if self.path:
+                write_atomic(self.path, json.dumps(self.data).encode())
+
+class NegativeCache(JSONState):
+    def __init__(self, path=None, ttl_hours=6):
+        super().__init__(path)
+        self.ttl_hours = ttl_hours
+
+    def add(self, url):
+        self.set(url, time.time() + self.ttl_hours * 3600)
+
+    def __contains__(self, url):
+        return (self.get(url) or 0) > time.time()
+
+class PuzzleStore:
+    def __init__(self, path=None, ttl_hours=20):
+        self.path = path
+        self.ttl_hours = ttl_hours
+        self.index = JSONState()
+
+    def open(self, path):
+        self.path = path
+        self.index.load(os.path.join(path, 'index.json'))
+
+    def object_path(self, digest):
+        return os.path.join(self.path, 'objects', digest[:2], digest)
+
+    def lookup(self, url):
+        if not self.path:
+            return None
+
+        # an undated link serves a new puzzle each day, so what it gave
+        # for another day's run is never reused, however recent
+        entry = self.index.get(url)
+        if (not entry or entry.get('date') != RUN_DATE.date().isoformat()
+                or time.time() - entry['fetched'] > self.ttl_hours * 3600
+                or not os.path.exists(self.object_path(entry['sha256']))):
+            return None
+
+        return entry
+
+    def link(self, digest, filename):
+        tape.add_object(digest, self.object_path(digest))
+        path = day_path(filename)
+        if os.path.exists(path):
+            os.remove(path)
+        try:
+            os.link(self.object_path(digest), path)
+        except OSError:
+            shutil.copyfile(self.object_path(digest), path)
+
+    def add(self, url, tmp, digest, filename):
+        if not self.path:
+            os.replace(tmp, day_path(filename))
+            return
+
+        obj = self.object_path(digest)
+        if os.path.exists(obj):
+            os.remove(tmp)
+        else:
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+            os.replace(tmp, obj)
+
+        self.link(digest, filename)
+
+        if url:
+            self.index.set(url, {'sha256': digest, 'filename': filename,
+                                 'fetched': time.time(),
+                                 'date': RUN_DATE.date().isoformat()})
+
+    def add_bytes(self, data, filename, url=None):
+        digest = hashlib.sha256(data).hexdigest()
+        fd, tmp = tempfile.mkstemp(dir=DAY_DIR, suffix='.part')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        self.add(url, tmp, digest, filename)
+        return digest
+
+    def has(self, digest):
+        return bool(self.path) and os.path.exists(self.object_path(digest))
+
+class HTTPCache:
+    kept_headers = ['Content-Type', 'Content-Disposition',
+                    'ETag', 'Last-Modified']
+
+    def __init__(self, path=None):
+        self.path = path
+
+    def paths(self, url):
+        key = hashlib.sha256(url.encode()).hexdigest()
+        base = os.path.join(self.path, key[:2], key)
+        return base + '.json', base + '.body'
+
+    def get(self, url):
+        meta_path, body_path = self.paths(url)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            with open(body_path, 'rb') as f:
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        return meta, body
+
+    def put(self, url, res):
+        if not (res.headers.get('ETag') or res.headers.get('Last-Modified')):
+            return
+        meta = {
+            'url': res.url,
+            'encoding': res.encoding,
+            'headers': {h: res.headers[h] for h in self.kept_headers
+                        if h in res.headers},
+            }
+        meta_path, body_path = self.paths(url)
+        write_atomic(body_path, res.content)
+        write_atomic(meta_path, json.dumps(meta).encode())
+
+    def response(self, meta, body):
+        res = requests.Response()
+        res.status_code = 200
+        res.url = meta['url']
+        res.encoding = meta.get('encoding')
+        res.headers = CaseInsensitiveDict(meta['headers'])
+        res._content = body
+        return res
+
+class History:
+    # what earlier runs found: each day's records, and every feed entry and
+    # inbox message already looked at, so that a later run can pick up what
+    # was resolved before instead of fetching it again
+    def __init__(self, path=None):
+        self.path = path
+
+    @contextlib.contextmanager
+    def connect(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        try:
+            db.execute('CREATE TABLE IF NOT EXISTS records ('
+                       'date TEXT, position INTEGER, site TEXT, puzfile TEXT, '
+                       'problem TEXT, record TEXT, PRIMARY KEY (date, position))')
+            db.execute('CREATE INDEX IF NOT EXISTS records_site ON records (site, date)')
+            db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                       'key TEXT PRIMARY KEY, site TEXT, seen REAL, entry TEXT)')
+            yield db
+        finally:
+            db.close()
+
+    def save_records(self, date, records):
+        if not self.path:
+            return
+
+        with self.connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute('DELETE FROM records WHERE date = ?', (date,))
+            db.executemany('INSERT INTO records VALUES (?, ?, ?, ?, ?, ?)',
+                           [(date, position, rec.get('name', ''), rec.get('puzfile', ''),
+                             rec.get('problem', ''),
+                             json.dumps({f: rec.get(f, '') for f in HISTORY_FIELDS}))
+                            for position, rec in enumerate(records) if rec])
+            db.execute('COMMIT')
+
+    def records(self, date):
+        if not self.path:
+            return []
+
+        with self.connect() as db:
+            return [json.loads(record) for record, in db.execute(
+                    'SELECT record FROM records WHERE date = ? ORDER BY position',
+                    (date,))]
+
+    def last_success(self, site, before='99999999'):
+        if not self.path:
+            return None
+
+        with self.connect() as db:
+            date, = db.execute("SELECT max(date) FROM records WHERE site = ? AND date < ? "
+                               "AND puzfile != '' AND problem = ''",
+                               (site, before)).fetchone()
+        return date
+
+    def entry(self, key):
+        if not self.path or not key:
+            return None
+
+        with self.connect() as db:
+            row = db.execute('SELECT entry FROM entries WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def remember(self, key, site, entry):
+        if not self.path or not key:
+            return
+
+        with self.connect() as db:
+            db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                       (key, site, time.time(), json.dumps(entry)))
+
+    def prune(self, days=30):
+        if not self.path:
+            return
+
+        with self.connect() as db:
+            db.execute('DELETE FROM entries WHERE seen < ?', (time.time() - days * 86400,))
+
+
+class TeeStream:
+    # stands in for a streamed response's raw body, keeping a copy of
+    # each chunk as it is read
+    def __init__(self, raw, body):
+        self.raw = raw
+        self.body = body
+
+    def stream(self, *args, **kwargs):
+        for chunk in self.raw.stream(*args, **kwargs):
+            self.body.extend(chunk)
+            yield chunk
+
+    def read(self, *args, **kwargs):
+        data = self.raw.read(*args, **kwargs)
+        self.body.extend(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+
+class Tape:
+    # --record keeps everything a run gets from the outside world: HTTP
+    # responses, IMAP replies, the sources sheet and xword-dl's answers,
+    # along with the cached state that decides what gets asked for.
+    # --replay hands them back in place of the network, so that a day's
+    # run can be repeated, and profiled, long after the sites have moved on.
+    state_files = ['strategies.json', 'negative.json', 'metadata.json',
+                   'latency.json', 'publish_times.json', 'history.sqlite']
+
+    def __init__(self):
+        self.mode = None
+        self.latency = False
+        self.lock = threading.Lock()
+        self.data = {}
+        self.queues = {}
+
+    @property
+    def replaying(self):
+        return self.mode == 'replay'
+
+    def record(self, cache_dir):
+        self.mode = 'record'
+        self.data = {'date': RUN_DATE.isoformat(), 'started': time.time(),
+                     'state': {}, 'objects': {}, 'http': [], 'calls': []}
+        for name in self.state_files:
+            try:
+                with open(os.path.join(cache_dir, name), 'rb') as f:
+                    self.data['state'][name] = f.read()
+            except OSError:
+                pass
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self.lock, gzip.open(path, 'wb') as f:
+            pickle.dump(self.data, f)
+
+    def replay(self, path, cache_dir, latency=False):
+        with gzip.open(path, 'rb') as f:
+            self.data = pickle.load(f)
+        self.mode = 'replay'
+        self.latency = latency
+        self.started = time.monotonic()
+
+        for entry in self.data['http']:
+            self.queues.setdefault(('http', entry['method'], entry['url']), []).append(entry)
+        for entry in self.data['calls']:
+            self.queues.setdefault(entry['key'], []).append(entry)
+
+        for name, data in self.data['state'].items():
+            write_atomic(os.path.join(cache_dir, name), data)
+        store = PuzzleStore(os.path.join(cache_dir, 'puzzles'))
+        for digest, data in self.data['objects'].items():
+            write_atomic(store.object_path(digest), data)
+
+        return datetime.fromisoformat(self.data['date'])
+
+    def time(self):
+        if self.replaying:
+            return self.data['started'] + time.monotonic() - self.started
+        return time.time()
+
+    def next(self, key, missing):
+        # the same request can be made more than once; the answers are
+        # given in the order they were recorded, the last one repeating
+        with self.lock:
+            entries = self.queues.get(key)
+            if not entries:
+                raise missing('not in the recording: {}'.format(' '.join(map(str, key))))
+            entry = entries.pop(0) if len(entries) > 1 else entries[0]
+
+        if self.latency:
+            time.sleep(entry['seconds'])
+        return entry
+
+    def call(self, kind, key, func):
+        key = (kind, *key)
+        if self.replaying:
+            entry = self.next(key, Exception)
+            if 'error' in entry:
+                raise Exception(entry['error'])
+            return entry['result']
+
+        start = time.monotonic()
+        entry = {'key': key}
+        try:
+            entry['result'] = func()
+            return entry['result']
+        except Exception as e:
+            entry['error'] = str(e)
+            raise
+        finally:
+            if self.mode == 'record':
+                entry['seconds'] = round(time.monotonic() - start, 3)
+                with self.lock:
+                    self.data['calls'].append(entry)
+
+    def response(self, method, url):
+        entry = self.next(('http', method, url), requests.ConnectionError)
+        if 'error' in entry:
+            raise getattr(requests, entry['error'], requests.RequestException)(entry['message'])
+
+        res = requests.Response()
+        res.status_code = entry['status']
+        res.reason = entry['reason']
+        res.url = entry['final_url']
+        res.headers = CaseInsensitiveDict(entry['headers'])
+        res.encoding = requests.utils.get_encoding_from_headers(res.headers)
+        res._content = bytes(entry['body'])
+        res._content_consumed = True
+        return res
+
+    def add_http(self, method, url, seconds, res=None, error=None, stream=False):
+        if self.mode != 'record':
+            return
+
+        entry = {'method': method, 'url': url, 'seconds': round(seconds, 3)}
+        if error:
+            entry.update(error=type(error).__name__, message=str(error))
+        else:
+            entry.update(status=res.status_code, reason=res.reason,
+                         final_url=res.url, headers=dict(res.headers))
+            if stream:
+                # only what the caller reads gets recorded, so downloads
+                # still stop at the size cap or on a bad first chunk
+                entry['body'] = bytearray()
+                res.raw = TeeStream(res.raw, entry['body'])
+            else:
+                entry['body'] = res.content
+        with self.lock:
+            self.data['http'].append(entry)
+
+    def add_cached(self, url, meta, body):
+        # a replay starts from an empty HTTP cache, so a response that
+        # only said 304 has to be kept as the body it stood for
+        if self.mode != 'record':
+            return
+
+        with self.lock:
+            for entry in reversed(self.data['http']):
+                if entry['url'] == url and entry.get('status') == 304:
+                    entry.update(status=200, reason='OK', final_url=meta['url'],
+                                 headers=meta['headers'], body=body)
+                    break
+
+    def add_stored(self, url, filename, path):
+        # likewise for a puzzle that came out of the store without a request
+        if self.mode != 'record':
+            return
+
+        with open(path, 'rb') as f:
+            body = f.read()
+        with self.lock:
+            self.data['http'].append({
+                'method': 'GET', 'url': url, 'seconds': 0, 'status': 200,
+                'reason': 'OK', 'final_url': url, 'body': body,
+                'headers': {'Content-Disposition': 'attachment; filename="{}"'.format(filename)}})
+
+    def add_object(self, digest, path):
+        if self.mode != 'record' or digest in self.data['objects']:
+            return
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        with self.lock:
+            self.data['objects'][digest] = data
+
+class TapedIMAP:
+    def __init__(self, server=None):
+        self.server = server
+
+    def __getattr__(self, name):
+        def call(*args):
+            # the password stays out of the recording
+            key = (name, '' if name == 'login' else repr(args))
+            return tape.call('imap', key, lambda: getattr(self.server, name)(*args))
+        return call
+
+class DeadlineExceeded(Exception):
+    pass
+
+deadlines = threading.local()
+
+def time_left():
+    deadline = getattr(deadlines, 'at', None)
+    return None if deadline is None else deadline - time.monotonic()
+
+def check_deadline():
+    left = time_left()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded('ran past its deadline')
+    return left
+
+def bind_deadline(func):
+    # carry the current deadline over to a pool thread
+    deadline = getattr(deadlines, 'at', None)
+
+    def bound(*args, **kwargs):
+        deadlines.at = deadline
+        try:
+            return func(*args, **kwargs)
+        finally:
+            deadlines.at = None
+    return bound
+
+class RunTrace:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = time.monotonic()
+        self.spans = []
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextlib.contextmanager
+    def stage(self, name, site=None):
+        stack = self.stack()
+        parent = stack[-1] if stack else None
+        span = {'site': site or (parent['site'] if parent else None),
+                'stage': name,
+                'parent': parent['stage'] if parent else None,
+                'start': round(time.monotonic() - self.started, 3),
+                'duration': 0, 'requests': 0, 'bytes': 0, 'outcome': 'ok'}
+        start = time.perf_counter()
+        stack.append(span)
+        try:
+            yield span
+        except Exception as e:
+            span['outcome'] = 'error: {}'.format(e)
+            raise
+        finally:
+            stack.pop()
+            span['duration'] = round(time.perf_counter() - start, 3)
+            with self.lock:
+                self.spans.append(span)
+
+    def record(self, site, stage, duration=0, outcome='ok', requests=0, nbytes=0):
+        with self.lock:
+            self.spans.append({'site': site, 'stage': stage, 'parent': None,
+                               'start': round(time.monotonic() - self.started - duration, 3),
+                               'duration': round(duration, 3), 'requests': requests,
+                               'bytes': nbytes, 'outcome': outcome})
+
+    def count(self, requests=0, nbytes=0):
+        # every enclosing stage is charged, so a site's span covers the
+        # requests made by all of the stages beneath it
+        with self.lock:
+            for span in self.stack():
+                span['requests'] += requests
+                span['bytes'] += nbytes
+
+    def bind(self, func):
+        # carry the current stages over to a pool thread
+        stack = list(self.stack())
+
+        def bound(*args, **kwargs):
+            self.local.stack = list(stack)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.local.stack = []
+        return bound
+
+    def sites(self):
+        with self.lock:
+            return sorted((span for span in self.spans
+                           if span['stage'] == 'site' and span['site']),
+                          key=lambda span: span['duration'], reverse=True)
+
+    def summary(self, count=5):
+        lines = []
+        for span in self.sites()[:count]:
+            lines.append('- {}: {:.1f}s, {} requests, {:.0f} KB ({})'.format(
+                span['site'], span['duration'], span['requests'],
+                span['bytes'] / 1024, span['outcome']))
+        return '\n'.join(lines)
+
+    def dump(self):
+        stages = {}
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span['start'])
+        for span in spans:
+            total = stages.setdefault(span['stage'], {'calls': 0, 'seconds': 0})
+            total['calls'] += 1
+            total['seconds'] = round(total['seconds'] + span['duration'], 3)
+
+        return json.dumps({
+            'date': RUN_DATE.strftime('%Y-%m-%d'),
+            'wall_seconds': round(time.monotonic() - self.started, 3),
+            'stages': stages,
+            'sites': self.sites(),
+            'spans': spans,
+            }, indent=1)
+
+def traced(stage):
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with run_trace.stage(stage) as span:
+                result = func(*args, **kwargs)
+                if not result:
+                    span['outcome'] = 'empty'
+                return result
+        return wrapper
+    return decorate
+
+class HTTPClient:
+    user_agent = 'Automatt / Daily Crossword Links bot'
+
+    def __init__(self, timeout=10, retries=3, backoff_factor=0.2, pool_size=10):
+        self.timeout = timeout
+        self.max_download = 10 * 1024 * 1024
+        self.probe_timeout = 5
+        self.probe_workers = 4
+        self.hedge_after = 0
+        self.latency = {}
+        self.lock = threading.Lock()
+        self.hedger = ThreadPoolExecutor(max_workers=16, thread_name_prefix='hedge')
+        self.throttle = HostThrottle()
+        self.cache = HTTPCache()
+        self.session = requests.Session()
+        self.session.headers.update({'User-Agent': self.user_agent})
+        self.settings = None
+        self.configure(retries=retries, backoff_factor=backoff_factor,
+                       pool_size=pool_size)
+
+    def configure(self, retries=3, backoff_factor=0.2, pool_size=10):
+        # new adapters would drop the pooled connections, which a process
+        # running one job after another wants to keep
+        settings = (retries, backoff_factor, pool_size)
+        if settings == self.settings:
+            return
+        self.settings = settings
+
+        retry = Retry(total=retries, backoff_factor=backoff_factor,
+                      status_forcelist=[502, 503, 504],
+                      allowed_methods=['HEAD', 'GET'])
+        # pool_connections is the number of hosts kept warm, pool_maxsize
+        # the number of connections kept for each of them
+        adapter = HTTPAdapter(pool_connections=100,
+                              pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+
+        expected = self.latency.get(urllib.parse.urlsplit(url).hostname or '')
+        if (self.hedge_after and expected and expected >= self.hedge_after
+                and method in ('GET', 'HEAD')):
+            return self.hedged(method, url, self.hedge_after, **kwargs)
+
+        return self.send(method, url, **kwargs)
+
+    def send(self, method, url, **kwargs):
+        check_deadline()
+        with self.throttle(url):
+            # waiting on the throttle may have used up what time was left
+            left = check_deadline()
+            if left is not None:
+                kwargs['timeout'] = min(kwargs['timeout'], left)
+
+            start = time.monotonic()
+            try:
+                res = self.exchange(method, url, **kwargs)
+            except requests.Timeout:
+                self.observe(url, kwargs['timeout'])
+                raise
+            self.observe(url, time.monotonic() - start)
+
+        # streamed bodies are counted by whoever reads them
+        run_trace.count(requests=1,
+                        nbytes=0 if kwargs.get('stream') else len(res.content))
+        return res
+
+    def exchange(self, method, url, **kwargs):
+        if tape.replaying:
+            return tape.response(method, url)
+
+        start = time.monotonic()
+        try:
+            res = self.session.request(method, url, **kwargs)
+        except requests.RequestException as e:
+            tape.add_http(method, url, time.monotonic() - start, error=e)
+            raise
+        tape.add_http(method, url, time.monotonic() - start, res,
+                      stream=kwargs.get('stream', False))
+        return res
+
+    def observe(self, url, seconds):
+        host = urllib.parse.urlsplit(url).hostname or ''
+        with self.lock:
+            previous = self.latency.get(host)
+            if previous is not None:
+                seconds = 0.7 * previous + 0.3 * seconds
+            self.latency[host] = round(seconds, 3)
+
+    def hedged(self, method, url, delay, **kwargs):
+        # a host that is usually slow gets a second copy of the request if
+        # the first hasn't answered in the time it usually takes, and
+        # whichever copy succeeds first is used
+        send = run_trace.bind(bind_deadline(self.send))
+        first = self.hedger.submit(send, method, url, **kwargs)
+        if wait([first], timeout=delay).done:
+            return first.result()
+
+        pending = {first, self.hedger.submit(send, method, url, **kwargs)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for other in pending:
+                        other.add_done_callback(
+                            lambda f: f.exception() is None and f.result().close())
+                    return future.result()
+
+        return first.result()
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def get_cached(self, url, fresh=False, **kwargs):
+        if not self.cache.path:
+            return self.get(url, **kwargs)
+
+        headers = dict(kwargs.pop('headers', None) or {})
+        entry = None if fresh else self.cache.get(url)
+
+        if entry:
+            meta, body = entry
+            if meta['headers'].get('ETag'):
+                headers['If-None-Match'] = meta['headers']['ETag']
+            if meta['headers'].get('Last-Modified'):
+                headers['If-Modified-Since'] = meta['headers']['Last-Modified']
+        elif fresh:
+            headers['Cache-Control'] = 'no-cache'
+
+        res = self.get(url, headers=headers, **kwargs)
+
+        if res.status_code == 304 and entry:
+            tape.add_cached(url, *entry)
+            return self.cache.response(*entry)
+
+        if res.status_code == 200:
+            self.cache.put(url, res)
+
+        return res
+
+    def head(self, url, **kwargs):
+        return self.request('HEAD', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+http_client = HTTPClient()
+puzzle_store = PuzzleStore()
+strategy_memo = JSONState()
+negative_cache = NegativeCache()
+metadata_memo = JSONState()
+host_latency = JSONState()
+publish_times = JSONState()
+history = History()
+tape = Tape()
+run_trace = RunTrace()
+
+SHEET_TITLE = 'Puzzle sources'
+
+class SheetSnapshots:
+    def __init__(self, path, keep=30):
+        self.path = path
+        self.keep = keep
+
+    def files(self):
+        try:
+            return sorted(f for f in os.listdir(self.path)
+                          if f.startswith('sheets-') and f.endswith('.json'))
+        except FileNotFoundError:
+            return []
+
+    def latest(self):
+        for filename in reversed(self.files()):
+            try:
+                with open(os.path.join(self.path, filename)) as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                continue
+        return None
+
+    def save(self, snapshot):
+        filename = 'sheets-{}.json'.format(snapshot['fetched'].replace(':', ''))
+        write_atomic(os.path.join(self.path, filename),
+                     json.dumps(snapshot).encode())
+        for old in self.files()[:-self.keep]:
+            os.remove(os.path.join(self.path, old))
+
+def sheet_modified_time(gc, sheet_id):
+    import gspread
+
+    res = gc.request('get', gspread.urls.DRIVE_FILES_API_V3_URL + '/' + sheet_id,
+                     params={'fields': 'modifiedTime',
+                             'supportsAllDrives': True})
+    return res.json()['modifiedTime']
+
+def fetch_sheets(gc, snapshot=None):
+    import gspread
+
+    if snapshot:
+        modified = sheet_modified_time(gc, snapshot['id'])
+        if (modified == snapshot['modified'] and
+                snapshot['fetched'][:10] == datetime.today().date().isoformat()):
+            print('sources sheet unchanged, reusing snapshot')
+            return snapshot
+        sh = gc.open_by_key(snapshot['id'])
+    else:
+        sh = gc.open(SHEET_TITLE)
+        modified = sheet_modified_time(gc, sh.id)
+
+    titles = [ws.title for ws in sh.worksheets()]
+    ranges = sh.values_batch_get([gspread.utils.absolute_range_name(title)
+                                  for title in titles])['valueRanges']
+
+    return {
+        'id': sh.id,
+        'modified': modified,
+        'fetched': datetime.now().isoformat(timespec='seconds'),
+        'order': titles,
+        'worksheets': {title: r.get('values', [])
+                       for title, r in zip(titles, ranges)},
+        }
+
+@functools.lru_cache(maxsize=None)
+def sheets_client(credentials):
+    # the client refreshes its own token, so one login serves every run
+    # made by a long-lived process
+    import gspread
+
+    return gspread.service_account(credentials)
+
+def load_sheets(credentials, snapshots, timeout=30):
+    latest = snapshots.latest()
+    result = {}
+
+    def fetch():
+        try:
+            gc = sheets_client(credentials)
+            result['snapshot'] = fetch_sheets(gc, latest)
+        except Exception as e:
+            result['error'] = e
+
+    worker = threading.Thread(target=fetch, daemon=True)
+    worker.start()
+    worker.join(timeout)
+
+    if 'snapshot' in result:
+        if result['snapshot'] is not latest:
+            snapshots.save(result['snapshot'])
+        return result['snapshot']
+
+    error = result.get('error') or 'timed out after {}s'.format(timeout)
+    if not latest:
+        raise Exception('Could not fetch the sources sheet: {}'.format(error))
+
+    print('could not fetch the sources sheet ({}), using snapshot from {}'
+          .format(error, latest['fetched']))
+    return latest
+
+def sheet_values(snapshot, title=None):
+    import gspread
+
+    values = snapshot['worksheets'][title or snapshot['order'][0]]
+    return gspread.utils.fill_gaps(values) if values else []
+
+def sheet_records(snapshot, title=None):
+    import gspread
+
+    values = sheet_values(snapshot, title)
+    if not values:
+        return []
+    keys = values[0]
+    return [dict(zip(keys, gspread.utils.numericise_all(row)))
+            for row in values[1:]]
+
+def sheet_column(snapshot, title, col=1):
+    column = [row[col - 1] for row in sheet_values(snapshot, title)]
+    while column and not column[-1]:
+        column.pop()
+    return column
+
+HTML_HEADER = textwrap.dedent("""\
+        <!DOCTYPE html>
+        <html lang="en">
+            <head>
+                <meta charset="utf-8" />
+                <title>Automatt Output</title>
+                <style>
+                    h1, p {{
+                        margin-left: 40px;
+                    }}
+                    a {{
+                        color: #f90;
+                        text-decoration: none;
+                    }}
+                    a:hover {{
+                        text-decoration: underline;
+                    }}
+                    body {{
+                        width: 750px;
+                    }}
+                    .unfetched:before, .fetched:before {{
+                        display: inline-block;
+                        width: 30px;
+                        margin-left: -30px;
+                    }}
+                    .unfetched:before {{
+                        content: '❌';
+                    }}
+                    .fetched:before {{
+                        content: '✔️';
+                    }}
+                </style>
+            </head>
+            <body>
+                <h1>{}</h1>
+                <p>\n""")
 
 def create_html_list(records):
     indent = "    "
 
-    html_list = textwrap.dedent("""\
-            <!DOCTYPE html>
-            <html lang="en">
-                <head>
-                    <meta charset="utf-8" />
-                    <title>Automatt Output</title>
-                    <style>
-                        h1, p {{
-                            margin-left: 40px;
-                        }}
-                        a {{
-                            color: #f90;
-                            text-decoration: none;
-                        }}
-                        a:hover {{
-                            text-decoration: underline;
-                        }}
-                        body {{
-                            width: 750px;
-                        }}
-                        .unfetched:before, .fetched:before {{
-                            display: inline-block;
-                            width: 30px;
-                            margin-left: -30px;
-                        }}
-                        .unfetched:before {{
-                            content: '❌';
-                        }}
-                        .fetched:before {{
-                            content: '✔️';
-                        }}
-                    </style>
-                </head>
-                <body>
-                    <h1>{}</h1>
-                    <p>\n""".format(datetime.today().strftime('%A, %B %-d, %Y')))
+    parts = [HTML_HEADER.format(RUN_DATE.strftime('%A, %B %-d, %Y'))]
 
     for rec in records:
         template = rec.get('template') or ''
@@ -85,16 +997,15 @@ def create_html_list(records):
             cls = 'unfetched'
 
         if rec['formatted']:
-
-            html_list += 3 * indent + '<span class="{}">'.format(cls)
-            html_list += "{}</span><br />\n".format(rec.get('formatted'))
+            parts.extend([3 * indent, '<span class="', cls, '">',
+                          rec['formatted'], '</span><br />\n'])
 
         elif not any(rec[key] for key in rec.keys()):
-            html_list += 2 * indent + "</p>\n" + 2 * indent + "<p>\n"
+            parts.extend([2 * indent, '</p>\n', 2 * indent, '<p>\n'])
 
-    html_list += 2 * indent + "</p>\n"
+    parts.extend([2 * indent, '</p>\n'])
 
-    return html_list
+    return ''.join(parts)
 
 def create_html_postscript(html):
     indent = "    "
@@ -103,83 +1014,271 @@ def create_html_postscript(html):
 
 def create_html_blocklist(entries, title=None):
     indent = "    "
-    html = ''
+    parts = []
     if title:
-        html += 2 * indent + "<p><strong>" + title + "</strong></p>\n\n"
+        parts.extend([2 * indent, '<p><strong>', title, '</strong></p>\n\n'])
 
-    html += 2 * indent + '<p>'
+    parts.extend([2 * indent, '<p>'])
 
     html_list = []
     for entry in entries:
-        e = ''
+        e = []
         if entry.get('Name') and entry.get('Link'):
-            e += '<a href="{}">{}</a>'.format(entry.get('Link'), 
-                                              entry.get('Name'))
+            e.append('<a href="{}">{}</a>'.format(entry.get('Link'),
+                                                  entry.get('Name')))
         elif entry.get('Name'):
-            e += entry.get('Name')
+            e.append(entry.get('Name'))
 
         if entry.get('Comment'):
-            e += ' ' + entry.get('Comment')
-        html_list.append(e)
+            e.extend([' ', entry.get('Comment')])
+        html_list.append(''.join(e))
 
-    html += ' | '.join(html_list) + '</p>\n\n'
+    parts.extend([' | '.join(html_list), '</p>\n\n'])
 
-    return html
+    return ''.join(parts)
 
-def get_possible_puzfiles(url):
-    headers = {'User-Agent': 'Automatt'}
-    res = requests.get(url, headers=headers)
-    soup = BeautifulSoup(res.text, 'html.parser')
-        
-    possible_puzfiles = [a.get('href', '') for a in soup.find_all('a') 
-                         if a.get('href','') and
-                         ('.puz' in a.get('href', '').lower()
-                          or '.jpz' in a.get('href','').lower()
-                          or any(s in a.get_text().lower() for 
-                                 s in ['.puz', 'acrosslite', 'across lite', 
-                                       'puz file', 'jpz'])
-                          or a.get_text().lower() == 'puz')
-                         and 'litsoft.com' not in a.get('href')]
+CSV_FIELDS = ['name', 'title', 'author', 'expected_title', 'expected_author',
+              'link', 'puzfile', 'formatted', 'problem']
+
+# the history keeps what %pagetitle needs too, which the CSV leaves out
+HISTORY_FIELDS = CSV_FIELDS + ['pagetitle']
+
+def create_csv(records):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, CSV_FIELDS, extrasaction='ignore')
+    writer.writeheader()
+    writer.writerows(records)
+    return buffer.getvalue()
+
+def read_csv(path):
+    records = {}
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            rec = {key: value for key, value in row.items() if key and value}
+            if rec:
+                records.setdefault(rec.get('name', ''), []).append(rec)
+    return records
+
+def read_history(date):
+    records = {}
+    for rec in history.records(date):
+        rec = {key: value for key, value in rec.items() if value}
+        if rec:
+            records.setdefault(rec.get('name', ''), []).append(rec)
+    return records
+
+RESOLVERS = []
+
+def resolver(pattern):
+    def register(func):
+        RESOLVERS.append((re.compile(pattern), func))
+        return func
+    return register
+
+def resolve_url(url):
+    for pattern, func in RESOLVERS:
+        match = pattern.search(url)
+        if match:
+            resolved = func(url, match)
+            if resolved:
+                return resolved
+    return None
+
+@resolver(r'drive\.google\.com/file/d/([^/?#]+)')
+def resolve_google_drive(url, match):
+    return 'https://drive.google.com/uc?export=download&id=' + match.group(1)
+
+@resolver(r'dropbox\.com/')
+def resolve_dropbox(url, match):
+    if not url.endswith('dl=1'):
+        return url + ('&dl=1' if '?' in url else '?dl=1')
+
+@resolver(r'crosshare\.org/(?:crosswords|embed)/([^/?#]+)')
+def resolve_crosshare(url, match):
+    return 'https://crosshare.org/api/puz/' + match.group(1)
+
+PUZFILE_HREF_RE = re.compile(r'\.puz|\.jpz')
+PUZFILE_TEXT_RE = re.compile(r'\.puz|acrosslite|across lite|puz file|jpz')
+
+class PuzfileLinkScanner(HTMLParser):
+    # Only <a> and <iframe> are kept, but open and close tags are tracked
+    # the way BeautifulSoup's html.parser tree builder nests them, so an
+    # anchor's text comes out exactly as a.get_text() would have it.
+    void_tags = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+                 'keygen', 'link', 'menuitem', 'meta', 'param', 'source',
+                 'track', 'wbr', 'basefont', 'bgsound', 'command', 'frame',
+                 'image', 'isindex', 'nextid', 'spacer'}
+    string_containers = {'rt', 'rp', 'style', 'script', 'template'}
+    preserve_whitespace_tags = {'pre', 'textarea'}
+    ascii_spaces = ' \n\t\x0c\r'
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.stack = []
+        self.anchors = []
+        self.iframe_srcs = []
+        self.data = []
+        self.closed_voids = collections.Counter()
+
+    def open_names(self):
+        return {name for name, _ in self.stack}
+
+    def end_data(self, kind='text'):
+        if not self.data:
+            return
+
+        data = ''.join(self.data)
+        self.data = []
+
+        open_names = self.open_names()
+
+        if (not open_names & self.preserve_whitespace_tags
+                and not data.strip(self.ascii_spaces)):
+            data = '\n' if '\n' in data else ' '
+
+        if kind == 'cdata' or (kind == 'text'
+                               and not open_names & self.string_containers):
+            for _, anchor in self.stack:
+                if anchor is not None:
+                    anchor[1].append(data)
+
+    def pop_to(self, name):
+        for index in range(len(self.stack) - 1, -1, -1):
+            if self.stack[index][0] == name:
+                del self.stack[index:]
+                return
+
+    def handle_starttag(self, name, attrs, handle_empty_element=True):
+        self.end_data()
+
+        attrs = {key: value or '' for key, value in attrs}
+        anchor = None
+
+        if name == 'a':
+            anchor = [attrs.get('href', ''), []]
+            self.anchors.append(anchor)
+        elif name == 'iframe':
+            self.iframe_srcs.append(attrs.get('src', ''))
+
+        self.stack.append((name, anchor))
+
+        if handle_empty_element and name in self.void_tags:
+            self.handle_endtag(name, check_already_closed=False)
+            self.closed_voids[name] += 1
+
+    def handle_startendtag(self, name, attrs):
+        self.handle_starttag(name, attrs, handle_empty_element=False)
+        self.handle_endtag(name)
+
+    def handle_endtag(self, name, check_already_closed=True):
+        if check_already_closed and self.closed_voids[name]:
+            self.closed_voids[name] -= 1
+        else:
+            self.end_data()
+            self.pop_to(name)
+
+    def handle_data(self, data):
+        self.data.append(data)
+
+    def handle_comment(self, data):
+        self.end_data()
+
+    def handle_decl(self, data):
+        self.end_data()
+
+    def handle_pi(self, data):
+        self.end_data()
+
+    def unknown_decl(self, data):
+        self.end_data()
+        if data.upper().startswith('CDATA['):
+            self.data.append(data[len('CDATA['):])
+            self.end_data('cdata')
+        else:
+            self.data.append(data)
+            self.end_data('declaration')
+
+    def close(self):
+        super().close()
+        self.end_data()
+
+def extract_puzfile_links(html, url):
+    scanner = PuzfileLinkScanner()
+    scanner.feed(html)
+    scanner.close()
+
+    possible_puzfiles = []
+
+    for href, text in scanner.anchors:
+        if not href or 'litsoft.com' in href:
+            continue
+
+        if PUZFILE_HREF_RE.search(href.lower()):
+            possible_puzfiles.append(href)
+            continue
+
+        text = ''.join(text).lower()
+        if PUZFILE_TEXT_RE.search(text) or text == 'puz':
+            possible_puzfiles.append(href)
 
     possible_puzfiles = [urllib.parse.urljoin(url, link) for link in
-                         possible_puzfiles if link]
+                         possible_puzfiles]
 
-    if 'crosshare.org/crosswords' in url:
-        url_components = url.split('/')
-        puzzle_id = url_components[url_components.index('crosswords') + 1]
-        possible_puzfiles.insert(0, 'https://crosshare.org/api/puz/{}'.format(puzzle_id))
+    resolved = resolve_url(url)
+    if resolved:
+        possible_puzfiles.insert(0, resolved)
 
-    for iframe in soup.find_all('iframe'):
-        src = iframe.get('src', '')
-        if 'crosshare.org/embed' in src:
-            src_components = src.split('/')
-            puzzle_id = src_components[src_components.index('embed') + 1]
-            possible_puzfiles.insert(0, 'https://crosshare.org/api/puz/{}'.format(puzzle_id))
+    for src in scanner.iframe_srcs:
+        resolved = resolve_url(src)
+        if resolved:
+            possible_puzfiles.insert(0, resolved)
 
     return possible_puzfiles
 
-def send_to_discord(msg, attachment, token, channel_id):
-    intents = discord.Intents.default()
-    client = discord.Client(intents=intents)
+@traced('scrape')
+def get_possible_puzfiles(url, fresh=False):
+    res = http_client.get_cached(url, fresh=fresh)
+    return extract_puzfile_links(res.text, url)
+
+DISCORD_API = 'https://discord.com/api/v10'
+
+def split_message(msg, limit=2000):
+    chunks = []
+    while len(msg) > limit:
+        cut = msg.rfind('\n', 0, limit)
+        if cut <= 0:
+            cut = limit
+        chunks.append(msg[:cut])
+        msg = msg[cut:].lstrip('\n')
+    chunks.append(msg)
+    return chunks
+
+def send_to_discord(msg, attachment, token=None, channel_id=None,
+                    webhook_url=None, timeout=None):
+    if webhook_url:
+        url, headers = webhook_url, {}
+    else:
+        url = '{}/channels/{}/messages'.format(DISCORD_API, channel_id)
+        headers = {'Authorization': 'Bot ' + token}
 
     print('sending to discord')
 
-    @client.event
-    async def on_ready():
-        channel = client.get_channel(channel_id)
-        if attachment:
-            filename = discord.File(attachment)
-            await channel.send(msg, file=filename)
+    chunks = split_message(msg)
+    for index, chunk in enumerate(chunks):
+        if attachment and index == len(chunks) - 1:
+            with open(attachment, 'rb') as f:
+                res = http_client.post(url, headers=headers, timeout=timeout,
+                                       data={'payload_json': json.dumps({'content': chunk})},
+                                       files={'files[0]': (os.path.basename(attachment), f)})
         else:
-            await channel.send(msg)
-        await client.close()
-
-    client.run(token)
+            res = http_client.post(url, headers=headers, timeout=timeout,
+                                   json={'content': chunk})
+        res.raise_for_status()
 
-def send_to_wordpress(draft_post, tags, token):
+def send_to_wordpress(draft_post, tags, token, timeout=None):
     wp_api_url = 'https://public-api.wordpress.com/rest/v1.1/sites/dailycrosswordlinks.com/posts/new?context=edit'
     post_data = {
-        'title': datetime.today().strftime('%A, %B %-d, %Y'),
+        'title': RUN_DATE.strftime('%A, %B %-d, %Y'),
         'content': draft_post,
         #'tags': ','.join(tags),
         'status': 'draft',
@@ -189,52 +1288,236 @@ def send_to_wordpress(draft_post, tags, token):
         'Authorization': 'Bearer ' + token,
     }
 
-    requests.post(wp_api_url, data=post_data, headers=wp_headers)
+    res = http_client.post(wp_api_url, data=post_data, headers=wp_headers,
+                           timeout=timeout)
+    res.raise_for_status()
 
-def handle_inbox_check(site, mailserver):
-    records = []
+def send_email(from_address, password, recipients, subject, contents, timeout=None):
+    import yagmail
 
-    site_from_address = site.get('Email address')
+    yag = yagmail.SMTP(from_address, password, timeout=timeout)
+    try:
+        yag.send(to=recipients, subject=subject, contents=contents)
+    finally:
+        yag.close()
+
+# seconds per attempt, and attempts after the first
+DELIVERY_POLICIES = {
+    'email': {'timeout': 120, 'retries': 1},
+    'discord': {'timeout': 60, 'retries': 2},
+    'wordpress': {'timeout': 60, 'retries': 2},
+    }
 
-    yesterday = datetime.today() - timedelta(days=1)
+def deliver(deliveries, policies, backoff=5):
+    results = {}
 
-    msg_ids = mailserver.search(['FROM', site_from_address, 'SINCE', yesterday])
+    def attempt(name, send, policy):
+        start = time.monotonic()
+        for tries in range(1, policy['retries'] + 2):
+            try:
+                with run_trace.stage('delivery', site=name):
+                    send(timeout=policy['timeout'])
+            except Exception as e:
+                error = e
+                if tries <= policy['retries']:
+                    time.sleep(backoff * tries)
+            else:
+                error = None
+                break
 
-    for msg_id, data in mailserver.fetch(msg_ids, 'RFC822').items():
+        results[name] = {'ok': error is None, 'tries': tries,
+                         'seconds': round(time.monotonic() - start, 1),
+                         'error': repr(error) if error else ''}
+
+    # daemon threads, so that a send that hangs past its timeout can't keep
+    # the run from finishing
+    start = time.monotonic()
+    threads = {}
+    for name, send in deliveries.items():
+        policy = policies[name]
+        threads[name] = threading.Thread(target=attempt, args=(name, send, policy),
+                                         daemon=True)
+        threads[name].start()
+
+    for name, thread in threads.items():
+        policy = policies[name]
+        limit = (policy['timeout'] + backoff) * (policy['retries'] + 1)
+        thread.join(max(0, start + limit - time.monotonic()))
+        if name not in results:
+            results[name] = {'ok': False, 'tries': None, 'seconds': limit,
+                             'error': 'gave up after {}s'.format(limit)}
+
+    return {name: results[name] for name in deliveries}
+
+def decode_header_value(value):
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'replace')
+    return str(email.header.make_header(email.header.decode_header(value or '')))
+
+def find_puzzle_part(structure, number=''):
+    if structure.is_multipart:
+        for index, part in enumerate(structure[0], start=1):
+            found = find_puzzle_part(part, '{}.{}'.format(number, index)
+                                           if number else str(index))
+            if found:
+                return found
+        return None
+
+    params = dict(zip(*[iter(structure[2] or ())] * 2))
+    filename = params.get(b'NAME') or params.get(b'name')
+
+    for field in structure[7:]:
+        if (isinstance(field, tuple) and len(field) == 2
+                and isinstance(field[0], bytes)
+                and field[0].lower() in (b'attachment', b'inline')):
+            disposition = dict(zip(*[iter(field[1] or ())] * 2))
+            filename = (disposition.get(b'FILENAME')
+                        or disposition.get(b'filename') or filename)
+            break
+
+    if not filename:
+        return None
+
+    filename = decode_header_value(filename)
+
+    if filename.lower().endswith('.puz') or filename.lower().endswith('.jpz'):
+        return number or '1', filename, (structure[5] or b'').upper()
+
+    return None
+
+def decode_part(payload, encoding):
+    if encoding == b'BASE64':
+        return base64.b64decode(payload)
+    elif encoding == b'QUOTED-PRINTABLE':
+        return quopri.decodestring(payload)
+    return payload
+
+def scan_inbox(mailserver, addresses, uidvalidity=None):
+    inbox = {address: [] for address in addresses}
+
+    if not addresses:
+        return inbox
+
+    yesterday = RUN_DATE - timedelta(days=1)
+
+    criteria = ['OR'] * (len(addresses) - 1)
+    for address in addresses:
+        criteria.extend(['FROM', address])
+    criteria.extend(['SINCE', yesterday])
+
+    msg_ids = mailserver.search(criteria)
+    if not msg_ids:
+        return inbox
+
+    # UIDs are only stable for as long as the folder's UIDVALIDITY is
+    keys = {msg_id: 'imap:{}:{}'.format(uidvalidity, msg_id) if uidvalidity else None
+            for msg_id in msg_ids}
+
+    new_ids = []
+    for msg_id in sorted(msg_ids):
+        seen = history.entry(keys[msg_id])
+        if not seen or (seen.get('sha256') and not puzzle_store.has(seen['sha256'])):
+            new_ids.append(msg_id)
+            continue
+
+        message = {'subject': seen['subject']}
+        if seen.get('sha256'):
+            message['filename'] = seen['filename']
+            message['sha256'] = seen['sha256']
+        for address in addresses:
+            if address.lower() in seen['senders']:
+                inbox[address].append(message)
+
+    if not new_ids:
+        return inbox
+
+    parts = {}
+    unseen = {}
+
+    for msg_id, data in sorted(mailserver.fetch(new_ids,
+            ['ENVELOPE', 'BODYSTRUCTURE']).items()):
+        envelope = data[b'ENVELOPE']
+        senders = ' '.join('{} <{}@{}>'.format(
+                               decode_header_value(a.name),
+                               decode_header_value(a.mailbox),
+                               decode_header_value(a.host))
+                           for a in envelope.from_ or ()).lower()
+
+        message = {'subject': decode_header_value(envelope.subject)}
+
+        found = find_puzzle_part(data[b'BODYSTRUCTURE'])
+        if found:
+            number, message['filename'], message['encoding'] = found
+            parts.setdefault(number, []).append((msg_id, message))
+
+        for address in addresses:
+            if address.lower() in senders:
+                inbox[address].append(message)
+
+        unseen[msg_id] = {'senders': senders, 'subject': message['subject']}
+
+    for number, messages in parts.items():
+        section = 'BODY.PEEK[{}]'.format(number)
+        response_key = 'BODY[{}]'.format(number).encode()
+        fetched = mailserver.fetch([msg_id for msg_id, _ in messages],
+                                   [section])
+        for msg_id, message in messages:
+            payload = fetched.get(msg_id, {}).get(response_key)
+            if payload:
+                message['payload'] = decode_part(payload,
+                                                 message.pop('encoding'))
+                unseen[msg_id].update(
+                        filename=message['filename'],
+                        sha256=hashlib.sha256(message['payload']).hexdigest())
+
+    for msg_id, seen in unseen.items():
+        history.remember(keys[msg_id], None, seen)
+
+    return inbox
+
+@traced('inbox')
+def handle_inbox_check(site, inbox):
+    records = []
+
+    for message in inbox.get(site.get('Email address'), []):
         record = {}
         record['name'] = site.get('Name', '')
+        record['pagetitle'] = message.get('subject')
 
-        msg = email.message_from_bytes(data[b'RFC822'])
-        record['pagetitle'] = msg.get('Subject')
-
-        for attachment in msg.get_payload():
-            filename = attachment.get_filename()
-            if filename and (filename.lower().endswith('.puz') or filename.lower().endswith('.jpz')):
-                print('saving puzzle as', filename)
-                open(filename, 'wb').write(attachment.get_payload(decode=True))
-                record['puzfile'] = filename
-                break
+        if message.get('payload'):
+            filename = message['filename']
+            print('saving puzzle as', filename)
+            record['sha256'] = puzzle_store.add_bytes(message['payload'],
+                                                      filename)
+            record['puzfile'] = filename
+        elif message.get('sha256'):
+            print('reusing puzzle', message['filename'], 'from an earlier run')
+            puzzle_store.link(message['sha256'], message['filename'])
+            record['sha256'] = message['sha256']
+            record['puzfile'] = message['filename']
 
         records.append(record)
 
     return records
 
 
+@traced('rss')
 def handle_rss_feed(site):
+    import feedparser
+
     records = []
 
     site_url = site.get('RSS')
 
-    cache_buster = '&' if '?' in site.get('RSS') else '?'
-    cache_buster += str(random.randint(100,999))
-
-    retries = Retry(total=10, backoff_factor=0.2)
+    fresh = bool(site.get('Fresh'))
 
-    with requests.Session() as s:
-        s.mount('http', HTTPAdapter(max_retries=retries))
-        s.headers.update({'User-Agent': 'Automatt / Daily Crossword Links bot'})
-        res = s.get(site.get('RSS') + cache_buster)
-        res.raise_for_status()
+    if fresh:
+        cache_buster = '&' if '?' in site_url else '?'
+        cache_buster += str(random.randint(100,999))
+        res = http_client.get(site_url + cache_buster)
+    else:
+        res = http_client.get_cached(site_url)
+    res.raise_for_status()
 
     f = feedparser.parse(res.content)
 
@@ -242,139 +1525,553 @@ def handle_rss_feed(site):
         raise Exception('RSS feed appears to be empty or invalid.')
 
     new_posts = [entry for entry in f.entries 
-                 if entry and time.mktime(time.gmtime()) - 
+                 if entry and time.mktime(time.gmtime(tape.time())) - 
                  time.mktime(entry.get('published_parsed',
                                        entry.get('updated_parsed')))
                  <= (86400 * 1 + 120)]
 
     for entry in new_posts:
-        record = {}
-        res = requests.head(entry.get('link'), allow_redirects=True)
-        link = res.url.split('&')[0]
+        key = entry.get('id') or entry.get('link')
+        key = key and 'rss:' + key
+        seen = history.entry(key)
+
+        if (seen and not fresh and seen.get('sha256')
+                and puzzle_store.has(seen['sha256'])):
+            print('reusing', seen['puzfile'], 'for', seen['link'], 'from an earlier run')
+            puzzle_store.link(seen['sha256'], seen['puzfile'])
+            records.append(seen)
+            continue
+
+        # a post without a puzzle yet is looked at again, in case one gets
+        # added, but where its link leads is already known
+        if seen:
+            link = seen['link']
+        else:
+            res = http_client.head(entry.get('link'), allow_redirects=True)
+            link = res.url.split('&')[0]
 
         print(entry.get('title','') + ':', link)
 
+        record = {}
         record['name'] = site.get('Name', f.get('feed').get('title',''))
         record['title'] = record['pagetitle'] = entry.get('title','')
         record['link'] = link
 
-        filename = handle_page(link)
+        filename = handle_page(link, fresh=fresh, key=site.get('Name'))
  
         if filename:
             record['puzfile'] = filename
+            record['sha256'] = file_digest(day_path(filename))
 
-        records.append(record)
+        history.remember(key, site.get('Name'), record)
+        records.append(dict(record))
 
     return records
 
-def handle_page(link):
-    possible_puzfiles = get_possible_puzfiles(link)
- 
-    filename = ''
+def url_pattern(url):
+    parts = urllib.parse.urlsplit(url)
+    segments = parts.path.split('/')
+    segments = ['*' if re.search(r'[\d.]', seg) else seg
+                for seg in segments[:-1]] + ['*']
+    return parts.netloc + '/'.join(segments)
+
+def remember_strategy(key, strategy, pattern=None):
+    if not key:
+        return
+
+    memo = strategy_memo.get(key)
+
+    if strategy:
+        if memo != {'strategy': strategy, 'pattern': pattern, 'failures': 0}:
+            strategy_memo.set(key, {'strategy': strategy, 'pattern': pattern,
+                                    'failures': 0})
+    elif memo:
+        memo = dict(memo, failures=memo['failures'] + 1)
+        strategy_memo.set(key, memo if memo['failures'] < 3 else None)
+
+@traced('probe')
+def probe_candidate(url, fresh=False):
+    target = resolve_url(url) or url
 
-    while possible_puzfiles and not filename:
-        url = possible_puzfiles.pop(0)
+    if not fresh and puzzle_store.lookup(target):
+        return True
+
+    try:
+        with http_client.get(target, stream=True, timeout=http_client.probe_timeout,
+                             headers={'Range': 'bytes=0-4095'}) as res:
+            res.raise_for_status()
+
+            if 'text/html' in res.headers.get('Content-Type', ''):
+                negative_cache.add(url)
+                return False
+
+            head = b''
+            for chunk in res.iter_content(chunk_size=4096):
+                head += chunk
+                if len(head) >= 4096:
+                    break
+            run_trace.count(nbytes=len(head))
+    except requests.RequestException:
+        # error statuses and timeouts may well clear up, so don't cache them
+        return False
+
+    if sniff_puzzle(head):
+        return True
+
+    negative_cache.add(url)
+    return False
+
+def serve_xword_dl(memory_mb=0):
+    # the other end of XwordPool: one job per line on stdin, one reply per
+    # line on stdout, and anything xword-dl prints goes to stderr
+    protocol = sys.stdout
+    sys.stdout = sys.stderr
+
+    import xword_dl
+
+    if memory_mb:
+        limit = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    def reply(**message):
+        protocol.write(json.dumps(message) + '\n')
+        protocol.flush()
+
+    reply(ready=True)
+
+    for line in sys.stdin:
+        job = json.loads(line)
         try:
-            filename = handle_direct_download(url).get('puzfile', '')
-        except:
-            pass
+            if job['kind'] == 'url':
+                puzzle, filename = xword_dl.by_url(job['argument'])
+            else:
+                puzzle, filename = xword_dl.by_keyword(job['argument'])
+            reply(filename=filename,
+                  data=base64.b64encode(puzzle.tobytes()).decode())
+        except Exception as e:
+            reply(error='{}: {}'.format(type(e).__name__, e))
+
+class XwordPool:
+    def __init__(self, size=2, timeout=60, memory_mb=1024):
+        self.size = size
+        self.timeout = timeout
+        self.memory_mb = memory_mb
+        self.lock = threading.Lock()
+        self.idle = queue.Queue()
+        self.workers = 0
+
+    def spawn(self):
+        worker = subprocess.Popen([sys.executable, os.path.join(BASE_DIR, 'automatt.py'),
+                                   '--xword-worker', str(self.memory_mb)],
+                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                  text=True)
+        worker.ready = False
+        return worker
+
+    def warm(self):
+        # workers start importing xword-dl straight away, so the first job
+        # doesn't wait on it
+        with self.lock:
+            while self.workers < self.size:
+                self.workers += 1
+                self.idle.put(self.spawn())
+
+    def discard(self, worker):
+        worker.kill()
+        worker.wait()
+        with self.lock:
+            self.workers -= 1
+        self.warm()
+
+    def close(self):
+        with self.lock:
+            self.size = 0
+        while True:
+            try:
+                self.discard(self.idle.get_nowait())
+            except queue.Empty:
+                break
 
-    if not filename:
-        print('attempting xword-dl download of', link)
+    def read(self, worker, deadline):
+        left = deadline - time.monotonic()
+        if left <= 0 or not select.select([worker.stdout], [], [], left)[0]:
+            raise TimeoutError('xword-dl gave no answer in time')
+        line = worker.stdout.readline()
+        if not line:
+            raise OSError('xword-dl worker exited with {}'.format(worker.wait()))
+        return json.loads(line)
+
+    def run(self, kind, argument):
+        timeout = self.timeout
+        left = check_deadline()
+        if left is not None:
+            timeout = min(timeout, left)
+        deadline = time.monotonic() + timeout
+
+        self.warm()
         try:
-            puzzle, filename = xword_dl.by_url(link)
-            print('Using xword-dl to save puz as {}'.format(filename))
-            puzzle.save(filename)
+            worker = self.idle.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError('no xword-dl worker was free in time')
+
+        try:
+            if not worker.ready:
+                self.read(worker, deadline)
+                worker.ready = True
+            worker.stdin.write(json.dumps({'kind': kind, 'argument': argument}) + '\n')
+            worker.stdin.flush()
+            reply = self.read(worker, deadline)
         except:
-            print('No puzzle found.')
-            filename = ''
+            # whatever it was doing, it isn't getting the chance to finish
+            self.discard(worker)
+            raise
+
+        self.idle.put(worker)
+
+        if 'error' in reply:
+            raise Exception(reply['error'])
+        return base64.b64decode(reply['data']), reply['filename']
+
+    def by_url(self, url):
+        return tape.call('xword', ('url', url), lambda: self.run('url', url))
+
+    def by_keyword(self, keyword):
+        return tape.call('xword', ('keyword', keyword), lambda: self.run('keyword', keyword))
+
+xword_pool = XwordPool()
+
+@traced('xword-dl')
+def page_via_xword_dl(link):
+    print('attempting xword-dl download of', link)
+    try:
+        data, filename = xword_pool.by_url(link)
+        print('Using xword-dl to save puz as {}'.format(filename))
+        puzzle_store.add_bytes(data, filename)
+    except:
+        print('No puzzle found.')
+        filename = ''
 
     return filename
 
+@traced('page')
+def handle_page(link, fresh=False, key=None):
+    memo = strategy_memo.get(key) if key else None
+    filename = ''
+
+    if memo and memo['strategy'] == 'xword-dl':
+        filename = page_via_xword_dl(link)
+        if filename:
+            remember_strategy(key, 'xword-dl')
+            return filename
+
+    resolved = resolve_url(link)
+    if resolved:
+        try:
+            filename = handle_direct_download(resolved, fresh=fresh).get('puzfile', '')
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            print('could not download', resolved + ':', str(e))
+
+        if filename:
+            remember_strategy(key, 'resolver')
+            return filename
+
+    possible_puzfiles = [url for url in get_possible_puzfiles(link, fresh=fresh)
+                         if url != resolved and (fresh or url not in negative_cache)]
+
+    if memo and memo['strategy'] == 'candidate':
+        possible_puzfiles.sort(key=lambda url: url_pattern(url) != memo['pattern'])
+
+    pool = ThreadPoolExecutor(max_workers=http_client.probe_workers)
+    probes = [pool.submit(run_trace.bind(bind_deadline(probe_candidate)), url, fresh) for url in possible_puzfiles]
+
+    # only the probe decides a link isn't a puzzle; a download that fails
+    # or runs out of time says nothing about the link itself
+    try:
+        for url, probe in zip(possible_puzfiles, probes):
+            try:
+                if not probe.result():
+                    continue
+                filename = handle_direct_download(url, fresh=fresh).get('puzfile', '')
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                print('could not download', url + ':', str(e))
+                continue
+
+            if filename:
+                remember_strategy(key, 'candidate', url_pattern(url))
+                break
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    if not filename and not (memo and memo['strategy'] == 'xword-dl'):
+        filename = page_via_xword_dl(link)
+        if filename:
+            remember_strategy(key, 'xword-dl')
+
+    if not filename:
+        remember_strategy(key, None)
+
+    return filename
+
+@traced('xword-dl')
 def handle_xword_download(site):
     record = {}
 
     argument = site.get('Tech').split(' ')[1]
     
-    puzzle, filename = xword_dl.by_keyword(argument)
+    data, filename = xword_pool.by_keyword(argument)
 
-    puzzle.save(filename)
+    record['sha256'] = puzzle_store.add_bytes(data, filename)
     record['puzfile'] = filename
 
     return record
 
-def handle_direct_download(link):
+def sniff_puzzle(head):
+    if b'ACROSS&DOWN\0' in head:
+        return 'puz'
+    elif head.startswith(b'PK\x03\x04'):
+        return 'jpz'
+    elif (head.lstrip(b'\xef\xbb\xbf \t\r\n').startswith(b'<')
+            and b'crossword-compiler' in head):
+        return 'jpz'
+    return None
+
+def stream_download(res, link, max_bytes, sniff_bytes=4096):
+    content_length = res.headers.get('Content-Length', '')
+    if content_length.isdigit() and int(content_length) > max_bytes:
+        raise Exception('Download at {} is {} bytes, over the {} byte limit'
+                        .format(link, content_length, max_bytes))
+
+    digest = hashlib.sha256()
+    head = b''
+    size = 0
+    sniffed = False
+
+    fd, tmp = tempfile.mkstemp(dir=DAY_DIR, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in res.iter_content(chunk_size=65536):
+                check_deadline()
+                size += len(chunk)
+                run_trace.count(nbytes=len(chunk))
+                if size > max_bytes:
+                    raise Exception('Download at {} is over the {} byte limit'
+                                    .format(link, max_bytes))
+
+                if not sniffed:
+                    head += chunk[:sniff_bytes - len(head)]
+                    if len(head) >= sniff_bytes:
+                        sniffed = True
+                        if not sniff_puzzle(head):
+                            raise Exception('Not a puzzle file at {}'.format(link))
+
+                digest.update(chunk)
+                f.write(chunk)
+
+        if not sniffed and not sniff_puzzle(head):
+            raise Exception('Not a puzzle file at {}'.format(link))
+    except:
+        os.remove(tmp)
+        raise
+
+    return tmp, digest.hexdigest()
+
+@traced('direct')
+def handle_direct_download(link, fresh=False):
     record = {}
 
     filename = ''
 
-    headers = {'User-Agent': 'Automatt'}
+    link = resolve_url(link) or link
 
-    if 'drive.google.com/file' in link:
-        google_id = link.split('/')[5]
-        link = 'https://drive.google.com/uc?export=download&id=' + google_id
-    elif 'dropbox.com' in link and not link.endswith('dl=1'):
-        link += '&dl=1' if '?' in link else '?dl=1'
+    stored = None if fresh else puzzle_store.lookup(link)
+    if stored:
+        print('Reusing stored puzzle {} from {}'.format(stored['filename'], link))
+        puzzle_store.link(stored['sha256'], stored['filename'])
+        tape.add_stored(link, stored['filename'], puzzle_store.object_path(stored['sha256']))
+        record['puzfile'] = stored['filename']
+        record['sha256'] = stored['sha256']
+        return record
     
-    res = requests.get(link, headers=headers)
-    res.raise_for_status() 
-
-    if link.split('?')[0].endswith('.puz') or link.split('?')[0].endswith('.jpz'):
-        filename = link.split('/')[-1].split('?')[0]
-        filename = urllib.parse.unquote(filename)
-    elif res.headers.get('Content-Disposition', ''):
-        cd = res.headers.get('Content-Disposition')
-        filename = re.findall('filename=(.+)', 
-                              cd)[0].split(';')[0].strip('"')
-
-    if filename.endswith('.puz'):
-        try:
-            p = puz.load(res.content)
+    with http_client.get(link, stream=True) as res:
+        res.raise_for_status() 
+
+        if link.split('?')[0].endswith('.puz') or link.split('?')[0].endswith('.jpz'):
+            filename = link.split('/')[-1].split('?')[0]
+            filename = urllib.parse.unquote(filename)
+        elif res.headers.get('Content-Disposition', ''):
+            cd = res.headers.get('Content-Disposition')
+            filename = re.findall('filename=(.+)', 
+                                  cd)[0].split(';')[0].strip('"')
+
+        if not (filename.endswith('.puz') or filename.endswith('.jpz')):
+            return record
+
+        tmp, digest = stream_download(res, link, http_client.max_download)
+
+    try:
+        if filename.endswith('.puz'):
+            import puz
+            try:
+                puz.read(tmp)
+            except:
+                raise Exception('Apparently malformed puzzle file at', link)
             print('Saving puz as {}'.format(filename))
-            p.save(filename)
+        puzzle_store.add(link, tmp, digest, filename)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
 
-            record['puzfile'] = filename
-        except:
-            raise Exception('Apparently malformed puzzle file at', link)
-    elif filename.endswith('.jpz'):
-        with open(filename, 'wb') as f:
-            f.write(res.content)
-        record['puzfile'] = filename
+    record['puzfile'] = filename
+    record['sha256'] = digest
 
     return record
 
     
+DATE_TOKENS = ['d', '-d', 'm', '-m', 'y', 'Y', 'B']
+RECORD_TOKENS = ['%link', '%homepage', '%sitename', '%pagetitle',
+                 '%author', '%puztitle', '%blank']
+
+# longest first, so that e.g. %yestd wins over %y
+TOKEN_RE = re.compile('|'.join(re.escape(t) for t in sorted(
+    RECORD_TOKENS + ['%yest' + t for t in DATE_TOKENS]
+                  + ['%' + t for t in DATE_TOKENS], key=len, reverse=True)))
+
+@functools.lru_cache(maxsize=4)
+def date_tokens(day):
+    yesterday = day - timedelta(1)
+    tokens = {'%yest' + t: yesterday.strftime('%' + t) for t in DATE_TOKENS}
+    tokens.update({'%' + t: day.strftime('%' + t) for t in DATE_TOKENS})
+    return tokens
+
+@functools.lru_cache(maxsize=4096)
+def compile_template(template):
+    parts = []
+    pos = 0
+    for match in TOKEN_RE.finditer(template):
+        parts.append((False, template[pos:match.start()]))
+        parts.append((True, match.group()))
+        pos = match.end()
+    parts.append((False, template[pos:]))
+    return tuple(parts)
+
 def format_string(template, record={}):
+    parts = compile_template(template)
+    if len(parts) == 1:
+        return template
+
+    puztitle = record.get('title') or record.get('expected_title') or 'tktktk'
     tokens = {
         '%link': record.get('link') or record.get('homepage',''),
         '%homepage': record.get('homepage') or '',
         '%sitename': record.get('name') or '',
-        '%pagetitle': record.get('pagetitle') or '%puztitle',
+        '%pagetitle': record.get('pagetitle') or puztitle,
         '%author': record.get('author') or record.get('expected_author') or 'tktktk',
-        '%puztitle': record.get('title') or record.get('expected_title') or 'tktktk',
-        '%blank': ''
+        '%puztitle': puztitle,
+        '%blank': '',
+        **date_tokens(RUN_DATE.date()),
         }
 
-    supported_date_tokens = ['d','-d','m','-m','y','Y','B']
- 
-    for t in ['%yest' + dt for dt in supported_date_tokens]:
-        yesterday = datetime.today() - timedelta(1)
-        tokens[t] = yesterday.strftime(t.replace('yest',''))
+    return ''.join(tokens[text] if is_token else text
+                   for is_token, text in parts)
+
+
+PUZ_HEADER = struct.Struct('<H 11s xH Q 4s 2s H 12s BBH H H')
+
+def read_puz_metadata(path):
+    import puz
+
+    with open(path, 'rb') as f:
+        data = f.read(4096)
+        start = data.find(b'ACROSS&DOWN\0') - 2
+        if start < 0:
+            data += f.read()
+            start = data.find(b'ACROSS&DOWN\0') - 2
+            if start < 0:
+                raise puz.PuzzleFormatError('Data does not appear to represent a puzzle.')
+
+        f.seek(start)
+        header = PUZ_HEADER.unpack(f.read(PUZ_HEADER.size))
+        version, width, height = header[4][:3], header[8], header[9]
+        encoding = 'ISO-8859-1' if int(version.split(b'.')[0]) < 2 else 'UTF-8'
+
+        # skip the solution and fill grids, then read the title and author
+        f.seek(2 * width * height, os.SEEK_CUR)
+        strings = b''
+        while strings.count(b'\0') < 2:
+            chunk = f.read(1024)
+            if not chunk:
+                raise puz.PuzzleFormatError('Puzzle strings section is truncated.')
+            strings += chunk
+
+    title, author = strings.split(b'\0')[:2]
+    return {'title': title.decode(encoding), 'author': author.decode(encoding)}
+
+def read_jpz_metadata(f):
+    path = []
+    metadata = {}
+
+    for event, elem in ElementTree.iterparse(f, events=('start', 'end')):
+        tag = elem.tag.rsplit('}', 1)[-1]
+
+        if event == 'start':
+            if not path and tag not in ['crossword-compiler',
+                                        'crossword-compiler-applet']:
+                raise Exception('{} is not a crossword-compiler document'.format(tag))
+            path.append(tag)
+            continue
+
+        if path[1:] == ['rectangular-puzzle', 'metadata', tag]:
+            metadata.setdefault(tag, ''.join(elem.itertext()).strip() or None)
+        elif path[1:] == ['rectangular-puzzle', 'metadata']:
+            break
+        path.pop()
+
+    return {'author': metadata['creator'], 'title': metadata['title']}
+
+@traced('metadata')
+def read_puzzle_metadata(path, digest=None):
+    if not digest:
+        with open(path, 'rb') as f:
+            digest = hashlib.file_digest(f, 'sha256').hexdigest()
+
+    metadata = metadata_memo.get(digest)
+    if metadata:
+        return metadata
+
+    # the stored copy is the same bytes, and is still there if the day's
+    # file has been moved or zipped away
+    source = puzzle_store.object_path(digest) if puzzle_store.has(digest) else path
+    if path.endswith('.puz'):
+        metadata = read_puz_metadata(source)
+    elif is_zipfile(source):
+        with ZipFile(source) as zf:
+            with zf.open(zf.namelist()[0]) as f:
+                metadata = read_jpz_metadata(f)
+    else:
+        with open(source, 'rb') as f:
+            metadata = read_jpz_metadata(f)
 
-    for t in ['%' + dt for dt in supported_date_tokens]:
-        tokens[t] = datetime.today().strftime(t)
+    metadata_memo.set(digest, metadata)
+    return metadata
 
-    for token in tokens:
-        template = template.replace(token, tokens[token])
+def site_template(site):
+    if any(site.get(tag) for tag in ['Bold', 'Normal']):
+        template = ' '.join(['<strong>' + site.get('Bold') + '</strong>',
+                             site.get('Normal')])
+    else:
+        template = '<strong><a href="%link">%sitename</a>: %puztitle</strong> by %author.'
 
-    return template
+    template += ' <em>' + (site.get('Italic') or 'tktktk') + '</em>'
 
+    return template
 
-def check_and_handle(site, mailserver):
+def scheduled_on(site, day):
     to_check_dow = []
     to_check_dom = []
-    records = []
-    problem = ''
 
     for index, weekday in enumerate(['Mon','Tue','Wed','Thu',
                                      'Fri','Sat','Sun']):
@@ -384,8 +2081,11 @@ def check_and_handle(site, mailserver):
     if site.get('DOM'):
         to_check_dom.extend([int(d) for d in str(site.get('DOM')).split(',')])
 
-    dow = datetime.today().weekday()
-    dom = datetime.today().day
+    return day.weekday() in to_check_dow or day.day in to_check_dom
+
+def check_and_handle(site, inbox):
+    records = []
+    problem = ''
 
     if site.get('RSS'):
         try:
@@ -395,11 +2095,11 @@ def check_and_handle(site, mailserver):
 
     if site.get('Email address'):
         try:
-            records.extend(handle_inbox_check(site, mailserver))
+            records.extend(handle_inbox_check(site, inbox))
         except Exception as e:
             problem += str(e) + '\n'
 
-    if not records and (dow in to_check_dow or dom in to_check_dom):
+    if not records and scheduled_on(site, RUN_DATE):
         record = {}
         try:
             if 'xword-dl' in site.get('Tech'):
@@ -407,11 +2107,13 @@ def check_and_handle(site, mailserver):
 
             elif 'direct' in site.get('Tech'):
                 link = format_string(site.get('Direct Link', ''))
-                record = handle_direct_download(link)
+                record = handle_direct_download(link,
+                                                fresh=bool(site.get('Fresh')))
 
             elif 'page' in site.get('Tech'):
                 link = format_string(site.get('Direct Link')) or site.get('Homepage')
-                filename = handle_page(link)
+                filename = handle_page(link, fresh=bool(site.get('Fresh')),
+                                       key=site.get('Name'))
                 if filename:
                     record = {'puzfile':filename}
 
@@ -434,29 +2136,21 @@ def check_and_handle(site, mailserver):
         rec['link'] = format_string(rec['link'], rec)
 
         if rec.get('puzfile') and rec.get('puzfile').endswith('.puz'):
-            p = puz.read(rec.get('puzfile'))
-            rec['author'] = p.author
-            rec['title'] = p.title or rec.get('title', '')
+            metadata = read_puzzle_metadata(rec.get('puzfile'), rec.get('sha256'))
+            rec['author'] = metadata['author']
+            rec['title'] = metadata['title'] or rec.get('title', '')
 
         elif rec.get('puzfile') and rec.get('puzfile').endswith('.jpz'):
             try:
-                if is_zipfile(rec.get('puzfile')):
-                    with ZipFile(rec.get('puzfile')) as zf:
-                        with zf.open(zf.namelist()[0]) as x:
-                            jpz_info = xmltodict.parse(x)
-                else:
-                    with open(rec.get('puzfile'), 'rb') as f:
-                        jpz_info = xmltodict.parse(f)
-
-                main_data = jpz_info.get('crossword-compiler') or jpz_info.get('crossword-compiler-applet')
-                metadata = main_data['rectangular-puzzle']['metadata']
-                rec['author'] = metadata['creator']
+                metadata = read_puzzle_metadata(rec.get('puzfile'), rec.get('sha256'))
+                rec['author'] = metadata['author']
                 rec['title'] = metadata['title']
 
             except Exception as e:
                 problem += 'JPZ parsing issue: ' + str(e) + '\n'
 
         if rec.get('author'):
+            from bs4 import BeautifulSoup
             rec['author'] = BeautifulSoup(rec['author']).get_text()
             rec['author'] = rec['author'].split('/')[0]
             rec['author'] = rec['author'].split(', edited')[0]
@@ -466,35 +2160,656 @@ def check_and_handle(site, mailserver):
                 rec['author'] = rec['author'][3:]
 
         if rec['name'] in ['Newsday', 'USA Today', 'BEQ', 'New York Times']:
+            from titlecase import titlecase
             rec['title'] = titlecase(rec.get('title', ''))
 
-        if any(site.get(tag) for tag in ['Bold', 'Normal']):
-            template = ' '.join(['<strong>' + site.get('Bold') + '</strong>',
-                                 site.get('Normal')])
+        rec['template'] = site_template(site)
+
+        rec['problem'] = problem
+
+    return records
+
+
+def process_site(site, inbox):
+    records = []
+    problems = []
+
+    if not any(site[key] for key in site.keys()):
+        records.append({})
+
+    try:
+        print('checking', site['Name'])
+        with run_trace.stage('site', site=site['Name']) as span:
+            records.extend(check_and_handle(site, inbox))
+            if any(rec.get('puzfile') for rec in records):
+                span['outcome'] = 'fetched'
+            elif any(rec.get('problem') for rec in records):
+                span['outcome'] = 'problem'
+            else:
+                span['outcome'] = 'nothing found'
+    except Exception as e:
+        print('issue encountered:', str(e))
+        # as a row of its own, so that the CSV shows the site failed and
+        # --retry-failed checks it again
+        records.append(problem_record(site, str(e)))
+
+    if (any('%homepage' in site.get(f) for f in ['Bold', 'Normal','Italic'])
+            and not site.get('Homepage')):
+        problems.append((site['Name'],
+            'No homepage specified: link likely broken'))
+
+    return records, problems
+
+def abandoned_site(site, reason):
+    if not any(site[key] for key in site.keys()):
+        return [{}], []
+
+    print('gave up on', site['Name'] + ':', reason)
+    run_trace.record(site['Name'], 'site', outcome='abandoned: ' + reason)
+
+    return [problem_record(site, reason)], []
+
+def problem_record(site, reason):
+    return {'name': site['Name'],
+            'homepage': site.get('Homepage', ''),
+            'link': format_string(site.get('Direct Link', '')),
+            'expected_author': site.get('Expected author', ''),
+            'expected_title': site.get('Expected title', ''),
+            'template': site_template(site),
+            'problem': reason}
+
+def run_with_deadlines(func, items, workers=8, item_deadline=None, budget=None,
+                       expired=None, done=None, grace=5):
+    # daemon threads rather than a ThreadPoolExecutor, so that an item still
+    # running well past its deadline can be given up on and left behind
+    # without holding up the rest of the run
+    results = [None] * len(items)
+    claimed = [False] * len(items)
+    finished = [False] * len(items)
+    running = {}
+    todo = collections.deque(range(len(items)))
+    cond = threading.Condition()
+    stop_at = time.monotonic() + budget if budget else None
+
+    def finish(index, result):
+        with cond:
+            if claimed[index]:
+                return
+            claimed[index] = True
+            results[index] = result
+            running.pop(index, None)
+        # the item only counts as finished once done has seen it, since the
+        # caller may clean up after the run as soon as everything has
+        try:
+            if done:
+                done(items[index], result)
+        finally:
+            with cond:
+                finished[index] = True
+                cond.notify_all()
+
+    def worker():
+        while True:
+            with cond:
+                if not todo:
+                    return
+                index = todo.popleft()
+                now = time.monotonic()
+                limits = [t for t in (stop_at, item_deadline and now + item_deadline)
+                          if t]
+                deadline = running[index] = min(limits) if limits else None
+
+            if stop_at and now >= stop_at:
+                finish(index, expired(items[index],
+                                      'the run ran out of time before it was checked'))
+                continue
+
+            deadlines.at = deadline
+            try:
+                result = func(items[index])
+            except Exception as e:
+                result = expired(items[index], str(e))
+            finally:
+                deadlines.at = None
+            finish(index, result)
+
+    def start_worker():
+        threading.Thread(target=worker, daemon=True).start()
+
+    for _ in range(min(workers, len(items))):
+        start_worker()
+
+    with cond:
+        while not all(finished):
+            now = time.monotonic()
+            for index, deadline in list(running.items()):
+                if deadline and now >= deadline + grace:
+                    overdue = index
+                    break
+            else:
+                waits = [deadline + grace - now for deadline in running.values()
+                         if deadline]
+                cond.wait(max(min(waits), 0.01) if waits else None)
+                continue
+
+            # its thread is stuck, so another one takes its place
+            running.pop(overdue)
+            start_worker()
+            cond.release()
+            try:
+                finish(overdue, expired(items[overdue],
+                                        'gave up after it ran past its deadline'))
+            finally:
+                cond.acquire()
+
+    return results
+
+
+class WorkQueue:
+    # sheet rows shared out between processes, possibly on several machines,
+    # through one SQLite file. A worker leases a batch of rows for long
+    # enough to check them; a row whose lease runs out without a result is
+    # handed to the next worker to ask, up to max_attempts times.
+    def __init__(self, path, max_attempts=3):
+        self.path = path
+        self.max_attempts = max_attempts
+
+    @contextlib.contextmanager
+    def connect(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        try:
+            db.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                       'run TEXT, position INTEGER, date TEXT, site TEXT, '
+                       'worker TEXT, lease_until REAL, attempts INTEGER DEFAULT 0, '
+                       'result TEXT, PRIMARY KEY (run, position))')
+            yield db
+        finally:
+            db.close()
+
+    def submit(self, run, date, sites):
+        with self.connect() as db:
+            db.executemany('INSERT INTO jobs (run, position, date, site) VALUES (?, ?, ?, ?)',
+                           [(run, position, date, json.dumps(site))
+                            for position, site in sites])
+
+    def lease(self, worker, count, seconds, run=None):
+        now = time.time()
+        with self.connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            rows = db.execute('SELECT run, position, date, site FROM jobs '
+                              'WHERE result IS NULL AND attempts < ? '
+                              'AND (lease_until IS NULL OR lease_until < ?) '
+                              'AND (? IS NULL OR run = ?) '
+                              'ORDER BY run, position LIMIT ?',
+                              (self.max_attempts, now, run, run, count)).fetchall()
+            # a batch is all from one run, so all for the same day
+            rows = [row for row in rows if row[0] == rows[0][0]]
+            db.executemany('UPDATE jobs SET worker = ?, lease_until = ?, '
+                           'attempts = attempts + 1 WHERE run = ? AND position = ?',
+                           [(worker, now + seconds, row[0], row[1]) for row in rows])
+            db.execute('COMMIT')
+
+        return [{'run': run, 'position': position, 'date': date,
+                 'site': json.loads(site)} for run, position, date, site in rows]
+
+    def complete(self, job, result):
+        with self.connect() as db:
+            db.execute('UPDATE jobs SET result = ? '
+                       'WHERE run = ? AND position = ? AND result IS NULL',
+                       (json.dumps(result), job['run'], job['position']))
+
+    def status(self, run):
+        with self.connect() as db:
+            return db.execute('SELECT position, result, attempts, lease_until '
+                              'FROM jobs WHERE run = ?', (run,)).fetchall()
+
+    def finish(self, run):
+        with self.connect() as db:
+            db.execute('DELETE FROM jobs WHERE run = ?', (run,))
+
+def queue_location(config, cache_dir):
+    return os.path.join(BASE_DIR, config.get('queue_path')
+                        or os.path.join(cache_dir, 'queue.sqlite'))
+
+def shard_result(result):
+    records, problems = result
+    files = {}
+    for rec in records:
+        if rec.get('puzfile') and os.path.exists(day_path(rec['puzfile'])):
+            with open(day_path(rec['puzfile']), 'rb') as f:
+                files[rec['puzfile']] = base64.b64encode(f.read()).decode()
+
+    names = {rec.get('name') for rec in records}
+    return {'records': records, 'problems': problems, 'files': files,
+            'worker': WORKER_ID,
+            'sites': [span for span in run_trace.sites() if span['site'] in names]}
+
+def work_queue(queue, config, run=None):
+    global RUN_DATE
+
+    jobs = queue.lease(WORKER_ID, config.get('workers', 8),
+                       config.get('site_deadline', 180) + 60, run=run)
+    if not jobs:
+        return 0
+
+    if run is None:
+        RUN_DATE = datetime.strptime(jobs[0]['date'], '%Y-%m-%d')
+
+    run_with_deadlines(lambda job: process_site(job['site'], {}), jobs,
+                       workers=config.get('workers', 8),
+                       item_deadline=config.get('site_deadline', 180),
+                       expired=lambda job, reason: abandoned_site(job['site'], reason),
+                       done=lambda job, result: queue.complete(job, shard_result(result)))
+    return len(jobs)
+
+def serve_queue(config, cache_dir):
+    global run_trace, DAY_DIR
+
+    queue = WorkQueue(queue_location(config, cache_dir))
+    idle = config.get('worker_idle', 60)
+    output_dir = os.getcwd()
+    last_job = time.monotonic()
+
+    print('worker', WORKER_ID, 'taking jobs from', queue.path)
+
+    while not idle or time.monotonic() - last_job < idle:
+        # puzzles are saved into a scratch directory and sent back with the
+        # results, so the worker can be on another machine from the run
+        run_trace = RunTrace()
+        scratch = tempfile.mkdtemp(dir=cache_dir)
+        DAY_DIR = os.path.abspath(scratch)
+        os.chdir(scratch)
+        try:
+            handled = work_queue(queue, config)
+        finally:
+            os.chdir(output_dir)
+            shutil.rmtree(scratch)
+
+        if handled:
+            last_job = time.monotonic()
         else:
-            template = '<strong><a href="%link">%sitename</a>: %puztitle</strong> by %author.'
+            time.sleep(1)
 
-        template += ' <em>' + (site.get('Italic') or 'tktktk') + '</em>'
+def run_sharded(config, cache_dir, items, func, expired, done):
+    # rows that only need the web go on the work queue for the worker
+    # processes; reused rows and those that need the inbox scan stay here
+    queue = WorkQueue(queue_location(config, cache_dir))
+    budget = config.get('run_budget', 900)
+    stop_at = time.monotonic() + budget if budget else None
+    run = '{}-{}-{}'.format(RUN_DATE.strftime('%Y%m%d'), WORKER_ID, int(time.time()))
+
+    shared = [index for index, (site, records) in enumerate(items)
+              if records is None and site.get('Name') and not site.get('Email address')]
+    local = [index for index in range(len(items)) if index not in set(shared)]
+    queue.submit(run, RUN_DATE.strftime('%Y-%m-%d'),
+                 [(index, items[index][0]) for index in shared])
+
+    workers = [subprocess.Popen([sys.executable, os.path.abspath(__file__), '--worker'],
+                                stdout=sys.stderr)
+               for _ in range(config.get('queue_workers', 0))]
+
+    # this process takes jobs from the queue too, so the run gets through
+    # them even if no worker ever turns up
+    def work():
+        while work_queue(queue, config, run=run):
+            pass
+    threading.Thread(target=work, daemon=True).start()
 
-        rec['template'] = template
+    results = [None] * len(items)
+    for index, result in zip(local, run_with_deadlines(
+            func, [items[index] for index in local],
+            workers=config.get('workers', 8),
+            item_deadline=config.get('site_deadline', 180),
+            budget=budget, expired=expired, done=done)):
+        results[index] = result
 
-        rec['problem'] = problem
+    pending = set(shared)
+    try:
+        while pending:
+            for position, result, attempts, lease_until in queue.status(run):
+                if position not in pending:
+                    continue
+
+                if result:
+                    result = json.loads(result)
+                    if result['worker'] != WORKER_ID:
+                        for filename, data in result['files'].items():
+                            puzzle_store.add_bytes(base64.b64decode(data), filename)
+                        for span in result['sites']:
+                            run_trace.record(span['site'], 'site', span['duration'],
+                                             '{} on {}'.format(span['outcome'],
+                                                               result['worker']),
+                                             span['requests'], span['bytes'])
+                    results[position] = (result['records'],
+                                         [tuple(problem) for problem in result['problems']])
+                elif attempts >= queue.max_attempts and lease_until < time.time():
+                    results[position] = expired(items[position],
+                                                'no worker could check it in {} tries'
+                                                .format(attempts))
+                elif stop_at and time.monotonic() >= stop_at:
+                    results[position] = expired(items[position],
+                                                'the run ran out of time before it was checked')
+                else:
+                    continue
+
+                pending.discard(position)
+                done(items[position], results[position])
+
+            if pending:
+                time.sleep(0.5)
+    finally:
+        queue.finish(run)
+        for worker in workers:
+            worker.terminate()
+            worker.wait()
+
+    return results
+
+
+def reusable_records(site, previous, names=None):
+    if not any(site[key] for key in site.keys()):
+        return None
+
+    name = site.get('Name', '')
+    records = previous.get(name, [])
+
+    if names:
+        if name.lower() in names:
+            return None
+    elif any(not rec.get('puzfile') or rec.get('problem')
+             or not os.path.exists(rec['puzfile']) for rec in records):
+        return None
+
+    for rec in records:
+        rec['homepage'] = site.get('Homepage', '')
+        rec['template'] = site_template(site)
 
     return records
 
 
-def main():
-    datestring = datetime.today().strftime('%Y%m%d')
+def day_start(day):
+    return datetime(day.year, day.month, day.day)
+
+def is_dated(template):
+    return any(is_token and text not in RECORD_TOKENS
+               for is_token, text in compile_template(template))
+
+def prefetchable(site, day, now):
+    if not site.get('Name'):
+        return False
 
-    os.chdir(os.path.dirname(__file__) or '.')
+    if site.get('RSS'):
+        return True
+
+    if not site.get('Tech') or not scheduled_on(site, day):
+        return False
+
+    # before midnight, an undated link or an xword-dl keyword still gets
+    # the day before's puzzle, so only links with the date in them are
+    # worth trying until the day itself has started
+    return now.date() >= day or is_dated_source(site)
+
+def is_dated_source(site):
+    return 'xword-dl' not in site['Tech'] and is_dated(site.get('Direct Link', ''))
+
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def puzzle_digests(directory):
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return set()
+    return {file_digest(os.path.join(directory, name)) for name in names
+            if name.endswith('.puz') or name.endswith('.jpz')}
+
+def poll_interval(name, day, misses, shortest=300, longest=3600):
+    # a source is polled most often around the time its puzzle has usually
+    # turned up, and less often the further from that time it is; one with
+    # no history backs off from the shortest interval as it keeps missing
+    history = publish_times.get(name)
+    if history:
+        expected = day_start(day) + timedelta(seconds=statistics.median(history))
+        wait = abs((expected - datetime.now()).total_seconds()) / 2
+    else:
+        wait = shortest * 2 ** misses
+    return min(max(wait, shortest), longest)
+
+def prefetch_day(config, cache_dir, day, until):
+    global RUN_DATE, run_trace, DAY_DIR
+    RUN_DATE = day_start(day)
+    datestring = RUN_DATE.strftime('%Y%m%d')
+
+    output_dir = os.getcwd()
     os.makedirs(datestring, exist_ok=True)
+    DAY_DIR = os.path.abspath(datestring)
+    os.chdir(datestring)
+
+    # polling before a puzzle is out isn't a failure of the strategy that
+    # found it last time, nor is a link that isn't a puzzle yet, so what
+    # the daemon learns stays in memory
+    strategy_memo.load(os.path.join(cache_dir, 'strategies.json'))
+    strategy_memo.path = None
+    negative_cache.load(os.path.join(cache_dir, 'negative.json'))
+    negative_cache.path = None
+
+    prefetched = JSONState()
+    prefetched.load(os.path.abspath('prefetch.json'))
+
+    shortest = config.get('prefetch_min_interval', 300)
+    longest = config.get('prefetch_max_interval', 3600)
+    done = set(prefetched.data)
+    misses = collections.Counter()
+    next_poll = {}
 
-    gc = gspread.service_account('gridsmaker-36ebd6ceb309.json')
-    sh = gc.open('Puzzle sources')
-    google_sheet = sh.sheet1.get_all_records()
+    # after midnight an undated source may not have moved on yet, so what
+    # it gives is only taken if it isn't the puzzle the day before got
+    previous = puzzle_digests(os.path.join(output_dir, (day - timedelta(1)).strftime('%Y%m%d')))
 
-    with open('email.yaml') as f:
-        config = yaml.safe_load(f)
+    print('prefetching puzzles for', day.isoformat(), 'until', until.isoformat())
+
+    while datetime.now() < until:
+        now = datetime.now()
+        try:
+            sheets = open_sheets(config, cache_dir)
+            sites = [site for site in sheet_records(sheets)
+                     if prefetchable(site, day, now)
+                     and site['Name'] not in done
+                     and next_poll.get(site['Name'], 0) <= time.time()]
+        except Exception as e:
+            print('issue encountered loading the sources sheet:', str(e))
+            sites = []
+
+        if sites:
+            run_trace = RunTrace()
+            # polls always go to the network: anything stored or cached
+            # is exactly what a poll is trying to see past
+            results = run_with_deadlines(lambda site: process_site(dict(site, Fresh=True), {}),
+                                         sites,
+                                         workers=config.get('workers', 8),
+                                         item_deadline=config.get('site_deadline', 180),
+                                         expired=abandoned_site)
+
+            for site, (records, problems) in zip(sites, results):
+                name = site['Name']
+                found = (records and
+                         all(rec.get('puzfile') and not rec.get('problem')
+                             for rec in records))
+                if (found and not site.get('RSS') and not is_dated_source(site)
+                        and any(file_digest(day_path(rec['puzfile'])) in previous
+                                for rec in records)):
+                    print(name, "still has the day before's puzzle")
+                    for rec in records:
+                        os.remove(day_path(rec['puzfile']))
+                    found = False
+                if found:
+                    print('prefetched', name)
+                    done.add(name)
+                    next_poll.pop(name, None)
+                    offset = (datetime.now() - RUN_DATE).total_seconds()
+                    publish_times.set(name, (publish_times.get(name, []) + [offset])[-14:])
+                    # feeds and the inbox are always read again in the
+                    # morning; all their polling does here is fill the store
+                    if not (site.get('RSS') or site.get('Email address')):
+                        prefetched.set(name, records)
+                else:
+                    misses[name] += 1
+                    next_poll[name] = time.time() + poll_interval(
+                            name, day, misses[name] - 1, shortest, longest)
+
+            with http_client.lock:
+                host_latency.update(http_client.latency)
+
+        wake = min((at for name, at in next_poll.items() if name not in done),
+                   default=time.time() + longest)
+        remaining = (until - datetime.now()).total_seconds()
+        time.sleep(max(min(wake - time.time(), remaining), 1))
+
+    os.chdir(output_dir)
+
+def run_daemon(config, cache_dir):
+    hours = config.get('prefetch_hours', 8)
+    until_hour = config.get('prefetch_until', 6)
+
+    while True:
+        now = datetime.now()
+        day = now.date()
+        if now.hour >= until_hour:
+            day += timedelta(1)
+
+        start = day_start(day) - timedelta(hours=hours)
+        until = day_start(day) + timedelta(hours=until_hour)
+        if now < start:
+            print('next prefetch starts at', start.isoformat())
+            time.sleep((start - now).total_seconds())
+            continue
+
+        prefetch_day(config, cache_dir, day, until)
+
+
+def load_config(path=None):
+    import yaml
+
+    with open(path or os.getenv('CONFIG_PATH')
+              or os.path.join(BASE_DIR, 'email.yaml')) as f:
+        return yaml.safe_load(f)
+
+def configure(config):
+    cache_dir = os.path.join(BASE_DIR, config.get('cache_dir', 'cache'))
+
+    http_client.cache.path = os.path.join(cache_dir, 'http')
+    puzzle_store.ttl_hours = config.get('store_ttl_hours', 20)
+    puzzle_store.open(os.path.join(cache_dir, 'puzzles'))
+    strategy_memo.load(os.path.join(cache_dir, 'strategies.json'))
+    negative_cache.ttl_hours = config.get('negative_ttl_hours', 6)
+    negative_cache.load(os.path.join(cache_dir, 'negative.json'))
+    metadata_memo.load(os.path.join(cache_dir, 'metadata.json'))
+    host_latency.load(os.path.join(cache_dir, 'latency.json'))
+    publish_times.load(os.path.join(cache_dir, 'publish_times.json'))
+    history.path = os.path.join(cache_dir, 'history.sqlite')
+    http_client.latency = dict(host_latency.data)
+    http_client.hedge_after = config.get('hedge_after', 3.0)
+    xword_pool.size = config.get('xword_workers', 2)
+    xword_pool.timeout = config.get('xword_timeout', 60)
+    xword_pool.memory_mb = config.get('xword_memory_mb', 1024)
+    http_client.timeout = config.get('http_timeout', 10)
+    http_client.max_download = config.get('max_download_bytes', 10 * 1024 * 1024)
+    http_client.probe_timeout = config.get('probe_timeout', 5)
+    http_client.probe_workers = config.get('probe_workers', 4)
+    http_client.throttle.per_host = config.get('per_host_limit', 2)
+    http_client.throttle.interval = config.get('per_host_interval', 1.0)
+    http_client.configure(retries=config.get('http_retries', 3),
+                          backoff_factor=config.get('http_backoff', 0.2),
+                          pool_size=config.get('per_host_limit', 2))
+
+    return cache_dir
+
+def open_sheets(config, cache_dir):
+    return load_sheets(os.path.join(BASE_DIR, config.get('google_credentials',
+                                                         'gridsmaker-36ebd6ceb309.json')),
+                       SheetSnapshots(os.path.join(cache_dir, 'sheets')),
+                       timeout=config.get('sheets_timeout', 30))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Prepare the Daily Crossword Links draft.')
+    parser.add_argument('-d', '--dry-run', action='store_true',
+                        help='print the message instead of sending it anywhere')
+    parser.add_argument('--retry-failed', action='store_true',
+                        help="reuse today's results and only check again the sources "
+                             'that found no puzzle or had a problem')
+    parser.add_argument('--sites', nargs='+', metavar='NAME',
+                        help="check again only these sources, reusing the rest of "
+                             "today's results")
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep running, fetching puzzles for the next day as '
+                             'they appear so that its run only has to collect them')
+    parser.add_argument('--record', action='store_true',
+                        help='keep everything this run fetches in a recording of '
+                             'the day, for --replay')
+    parser.add_argument('--replay', metavar='DATE',
+                        help='run again, offline and as a dry run, against the '
+                             'recording of DATE (YYYYMMDD) or a recording file')
+    parser.add_argument('--simulate-latency', action='store_true',
+                        help='with --replay, take as long over each response as '
+                             'it took when it was recorded')
+    parser.add_argument('--worker', action='store_true',
+                        help='check sources from the work queue for other runs '
+                             'until it has been idle for worker_idle seconds')
+    parser.add_argument('--xword-worker', type=int, metavar='MEMORY_MB',
+                        help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+def main(argv=None, progress=None):
+    global RUN_DATE, run_trace, tape, DAY_DIR
+    RUN_DATE = datetime.today()
+    run_trace = RunTrace()
+    tape = Tape()
+
+    args = parse_args(argv)
+    if args.xword_worker is not None:
+        return serve_xword_dl(args.xword_worker)
+
+    config = load_config()
+    recordings = os.path.join(BASE_DIR, config.get('recordings_dir') or
+                              os.path.join(config.get('cache_dir', 'cache'), 'recordings'))
+
+    if args.replay:
+        # a replay is a dry run with caches of its own, so it can neither
+        # send anything nor disturb the real ones
+        archive = args.replay
+        if not os.path.exists(archive):
+            archive = os.path.join(recordings, args.replay + '.gz')
+        replay_dir = os.path.join(recordings, 'replay')
+        shutil.rmtree(replay_dir, ignore_errors=True)
+        os.makedirs(replay_dir)
+        config = dict(config, output_dir=replay_dir,
+                      cache_dir=os.path.join(replay_dir, 'cache'),
+                      queue_workers=0, queue_path=None)
+        args.dry_run = True
+        RUN_DATE = tape.replay(archive, config['cache_dir'], args.simulate_latency)
+        print('replaying the run of', RUN_DATE.isoformat(), 'into', replay_dir)
+
+    datestring = RUN_DATE.strftime('%Y%m%d')
+
+    os.chdir(os.path.join(BASE_DIR, config.get('output_dir', '.')))
+
+    cache_dir = configure(config)
+    if args.record:
+        tape.record(cache_dir)
+
+    if args.daemon:
+        return run_daemon(config, cache_dir)
+
+    if args.worker:
+        return serve_queue(config, cache_dir)
+
+    os.makedirs(datestring, exist_ok=True)
+
+    with run_trace.stage('sheets'):
+        sheets = tape.call('sheets', (), lambda: open_sheets(config, cache_dir))
+    google_sheet = sheet_records(sheets)
 
     from_address = config['from_address']
     from_email = [*from_address][0]
@@ -505,70 +2820,156 @@ def main():
 
     imap_server = config['imap_server']
 
-    mailserver = IMAPClient(imap_server)
+    if tape.replaying:
+        mailserver = TapedIMAP()
+    else:
+        from imapclient import IMAPClient
+        mailserver = TapedIMAP(IMAPClient(imap_server))
     mailserver.login(from_email, password)
-    mailserver.select_folder('INBOX')
+    folder = mailserver.select_folder('INBOX')
 
+    DAY_DIR = os.path.abspath(datestring)
     os.chdir(datestring)
 
     daily_records = []
     possible_problems = []
 
-    for site in google_sheet:
-        if not any(site[key] for key in site.keys()):
-            daily_records.append({})
-
+    reused = [None] * len(google_sheet)
+    if args.retry_failed or args.sites:
         try:
-            print('checking', site['Name'])
-            daily_records.extend(check_and_handle(site, mailserver))
-            time.sleep(1)
-        except Exception as e:
-            print('issue encountered:', str(e))
-            possible_problems.append((site['Name'], str(e)))
+            try:
+                previous = read_history(datestring)
+            except sqlite3.Error as e:
+                print('could not read the run history:', str(e))
+                previous = None
+            previous = previous or read_csv(datestring + '.csv')
+        except OSError:
+            print('no results from earlier today, checking every source')
+        else:
+            names = {name.lower() for name in args.sites or []}
+            reused = [reusable_records(site, previous, names)
+                      for site in google_sheet]
+            for name in names - {site.get('Name', '').lower() for site in google_sheet}:
+                print('no source named', name)
+    else:
+        prefetched = JSONState(os.path.abspath('prefetch.json')).read()
+        reused = [reusable_records(site, prefetched)
+                  if site.get('Name') in prefetched
+                  and not (site.get('RSS') or site.get('Email address')) else None
+                  for site in google_sheet]
+        if prefetched:
+            print('using prefetched puzzles for',
+                  len([records for records in reused if records]), 'sources')
+
+    to_check = [site for site, records in zip(google_sheet, reused)
+                if records is None]
+
+    addresses = list(dict.fromkeys(site.get('Email address')
+                                   for site in to_check
+                                   if site.get('Email address')))
+    try:
+        with run_trace.stage('inbox scan'):
+            inbox = scan_inbox(mailserver, addresses, folder.get(b'UIDVALIDITY'))
+    except Exception as e:
+        print('issue encountered checking the inbox:', str(e))
+        possible_problems.append(('Email inbox', str(e)))
+        inbox = {}
+
+    checked = [site for site in to_check if site.get('Name')]
+    completed = iter(range(1, len(checked) + 1))
+
+    def check(item):
+        site, records = item
+        if records is not None:
+            return records, []
+        return process_site(site, inbox)
+
+    def report(item, result):
+        site, reused_records = item
+        records, problems = result
+        if progress and reused_records is None and site.get('Name'):
+            progress({'site': site['Name'],
+                      'done': next(completed),
+                      'total': len(checked),
+                      'found': any(rec.get('puzfile') for rec in records),
+                      'problems': [str(p) for _, p in problems]
+                                  + [rec['problem'] for rec in records
+                                     if rec.get('problem')]})
+
+    items = list(zip(google_sheet, reused))
+    # xword-dl is slow to import, so its workers get a head start when a
+    # source is going to need them; otherwise the first page that falls
+    # back to it starts them
+    if not tape.replaying and any('xword-dl' in (site.get('Tech') or '')
+                                  for site in to_check):
+        xword_pool.warm()
+    expired = lambda item, reason: abandoned_site(item[0], reason)
+    # worker processes' traffic wouldn't be recorded, so recorded runs
+    # check every source here
+    if (config.get('queue_workers') or config.get('queue_path')) and not args.record:
+        results = run_sharded(config, cache_dir, items, check, expired, report)
+    else:
+        results = run_with_deadlines(check, items,
+                                     workers=config.get('workers', 8),
+                                     item_deadline=config.get('site_deadline', 180),
+                                     budget=config.get('run_budget', 900),
+                                     expired=expired, done=report)
+
+    for records, problems in results:
+        daily_records.extend(records)
+        possible_problems.extend(problems)
 
-        if (any('%homepage' in site.get(f) for f in ['Bold', 'Normal','Italic'])
-                and not site.get('Homepage')):
-            possible_problems.append((site['Name'],
-                'No homepage specified: link likely broken'))
+    with http_client.lock:
+        host_latency.update(http_client.latency)
 
     possible_problems.extend([(rec.get('name'), rec.get('problem')) for
         rec in daily_records if rec.get('problem')])
      
     with open('index.html', 'w') as f:
-        html_doc = create_html_list(daily_records)
-        for graf in sh.worksheet('Post-script').col_values(1):
-            html_doc += create_html_postscript(graf)
-        html_doc += create_html_blocklist(
-                sh.worksheet('Other American').get_all_records(),
-                title='Other American-style links:')
-        html_doc += create_html_blocklist(
-                sh.worksheet('Other Cryptic/Variety').get_all_records(),
-                title='Other Cryptic/Variety links:')
-        html_doc += """
+        html_parts = [create_html_list(daily_records)]
+        html_parts.extend(create_html_postscript(graf)
+                          for graf in sheet_column(sheets, 'Post-script'))
+        html_parts.append(create_html_blocklist(
+                sheet_records(sheets, 'Other American'),
+                title='Other American-style links:'))
+        html_parts.append(create_html_blocklist(
+                sheet_records(sheets, 'Other Cryptic/Variety'),
+                title='Other Cryptic/Variety links:'))
+        html_parts.append("""
         </body>
-    </html>"""
+    </html>""")
+        html_doc = ''.join(html_parts)
         f.write(html_doc)
 
     with open(datestring + '.csv', 'w') as f:
-        fields = ['name', 'title', 'author', 'expected_title', 'expected_author',
-                  'link', 'puzfile', 'formatted', 'problem']
-        writer = csv.DictWriter(f, fields, extrasaction='ignore')
-        writer.writeheader()
-        for row in daily_records:
-            writer.writerow(row)
+        f.write(create_csv(daily_records))
+
+    try:
+        history.save_records(datestring, daily_records)
+        history.prune(config.get('history_entry_days', 30))
+    except sqlite3.Error as e:
+        print('could not save the run history:', str(e))
+
+    with open(datestring + '.trace.json', 'w') as f:
+        f.write(run_trace.dump())
+
+    if args.record:
+        tape.save(os.path.join(recordings, datestring + '.gz'))
+        print('recorded this run in', os.path.join(recordings, datestring + '.gz'))
 
     os.chdir('..')
     with ZipFile(datestring + '.zip', 'w') as zipf:
         for f in os.listdir(datestring):
-            zipf.write(datestring + '/' + f, f)
+            if not f.endswith('.trace.json') and f != 'prefetch.json':
+                zipf.write(datestring + '/' + f, f)
     
-    subject = datetime.today().strftime(subject)
+    subject = RUN_DATE.strftime(subject)
     message = message.format(
                 entrycount=len([e for e in daily_records if e]),
                 puzcount=len([e for e in daily_records if e.get('puzfile')]))
 
     try:
-        reminders = sh.worksheet('Reminder').get_all_records()
+        reminders = sheet_records(sheets, 'Reminder')
     except Exception as e:
         reminders = ''
         possible_problems.append('Fetching reminders failed. Check the sources doc for today\'s reminders.')
@@ -577,7 +2978,7 @@ def main():
     for r in reminders:
         try:
             days = [int(d) for d in str(r.get('DOM')).split(',')]
-            if datetime.today().day in days:
+            if RUN_DATE.day in days:
                 to_remind += "- "
                 to_remind += r.get('Text') or ''
                 to_remind += '\n'
@@ -594,37 +2995,58 @@ def main():
         message += textwrap.dedent("""\n
         The following sites may have had issues:\n""")
         for p in possible_problems:
-            message += "- " + p[0] + ": " + str(p[1]).strip() + '\n'
-
-    if '-d' not in sys.argv:
-        try:
-            yag = yagmail.SMTP(from_address, password)
-            yag.send(to=recipients,
-                     subject=subject,
-                     contents=[message, datestring + '.zip'])
-        except Exception as err:
-            print('Could not send email. Skipping.')
-            with open('automatt_error.txt', 'a') as f:
-                f.write('Email issue: ' + repr(e) + '\n')
-        try:
-            send_to_discord(message, datestring + '.zip',
-                            config['discord_token'], config['discord_channel_id'])
-        except Exception as err:
-            print('Could not post to Discord. Skipping.')
-            with open('automat_error.txt', 'a') as f:
-                f.write('Discord issue: ' + repr(e) + '\n')
-        try:
-            draft_post = html_doc.split('</h1>')[1]
-            wp_tags = [rec.get('author') for rec in daily_records
-                            if rec.get('author')]
-            send_to_wordpress(draft_post, wp_tags, config['wordpress_token'])
-        except Exception as err:
-            print('Could not send email. Skipping.')
-            with open('automatt_error.txt', 'a') as f:
-                f.write('Wordpress issue: ' + repr(e) + '\n')
+            message += "- " + p[0] + ": " + str(p[1]).strip()
+            try:
+                last = history.last_success(p[0], before=datestring)
+            except sqlite3.Error:
+                last = None
+            if last:
+                message += datetime.strptime(last, '%Y%m%d').strftime(
+                        ' (last found a puzzle %b %-d)')
+            message += '\n'
+
+    slowest = run_trace.summary(config.get('trace_slowest', 5))
+    if slowest:
+        message += '\n\nSlowest sources this run:\n'
+        message += slowest + '\n'
+
+    delivered = {}
+    if not args.dry_run:
+        deliveries = {'email': functools.partial(send_email, from_address, password,
+                                                 recipients, subject,
+                                                 [message, datestring + '.zip'])}
+        if config.get('discord_webhook_url') or config.get('discord_token'):
+            deliveries['discord'] = functools.partial(
+                    send_to_discord, message, datestring + '.zip',
+                    token=config.get('discord_token'),
+                    channel_id=config.get('discord_channel_id'),
+                    webhook_url=config.get('discord_webhook_url'))
+        if config.get('wordpress_token'):
+            deliveries['wordpress'] = functools.partial(
+                    send_to_wordpress, html_doc.split('</h1>')[1],
+                    [rec.get('author') for rec in daily_records if rec.get('author')],
+                    config['wordpress_token'])
+
+        policies = {name: {'timeout': config.get(name + '_timeout', policy['timeout']),
+                           'retries': config.get(name + '_retries', policy['retries'])}
+                    for name, policy in DELIVERY_POLICIES.items()}
+
+        delivered = deliver(deliveries, policies)
+        for name, result in delivered.items():
+            if result['ok']:
+                print('{} delivered in {}s'.format(name, result['seconds']))
+            else:
+                print('Could not deliver by {} ({}s). Skipping.'.format(name, result['seconds']))
+                with open('automatt_error.txt', 'a') as f:
+                    f.write('{} issue: {}\n'.format(name, result['error']))
+
+        with open(os.path.join(datestring, datestring + '.trace.json'), 'w') as f:
+            f.write(run_trace.dump())
     else:
         print(message)
 
+    return message, delivered
+
 
 if __name__ == '__main__':
     try:
@@ -0,0 +1,455 @@
+#!/usr/bin/env python
+
+# Offline end-to-end benchmark for automatt.main().
+#
+#     python bench/e2e.py --sources 200 --latency 0.05 --fail-rate 0.02
+#
+# Every outside service is replaced with a local stand-in: feeds, pages and
+# puzzle files come from HTTP fixture servers on loopback addresses (one per
+# simulated host), the inbox from an in-memory IMAP stand-in, the sources
+# spreadsheet from a stubbed gspread client, and the run is a dry run so
+# nothing is sent anywhere. The report covers wall time, requests served,
+# peak memory and time spent in each pipeline stage.
+
+import argparse
+import base64
+import collections
+import contextlib
+import functools
+import http.server
+import io
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from email.utils import formatdate
+
+import gspread
+import imapclient
+import puz
+import yaml
+
+from imapclient.response_parser import parse_fetch_response
+from imapclient.response_types import Address, Envelope
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import automatt
+
+STAGES = ['load_sheets', 'scan_inbox', 'process_site', 'check_and_handle',
+          'handle_rss_feed', 'handle_inbox_check', 'handle_page',
+          'get_possible_puzfiles', 'probe_candidate', 'handle_direct_download',
+          'read_puzzle_metadata', 'create_html_list', 'create_csv']
+
+WEEKDAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+
+
+def make_puzzle(index):
+    p = puz.Puzzle()
+    p.width = p.height = 15
+    p.solution = 'A' * 225
+    p.fill = '-' * 225
+    p.clues = ['Clue {}'.format(n) for n in range(60)]
+    p.title = 'Synthetic puzzle {}'.format(index)
+    p.author = 'By Constructor {}'.format(index)
+    return p.tobytes()
+
+
+def make_page(index, filler):
+    comments = ''.join('<div class="comment"><p>Comment {} on the puzzle, '
+                       '<a href="/u/{}">reply</a></p></div>\n'.format(n, n)
+                       for n in range(filler))
+    return ('<html><head><title>Puzzle {0}</title></head><body>'
+            '<article><h1>Puzzle {0}</h1>'
+            '<p><a href="/files/{0}.puz">Download the .puz</a></p></article>'
+            '{1}</body></html>').format(index, comments).encode()
+
+
+def make_feed(index, base):
+    return ('<?xml version="1.0"?><rss version="2.0"><channel>'
+            '<title>Feed {0}</title><link>{1}/</link>'
+            '<item><title>Puzzle {0}</title><link>{1}/post/{0}</link>'
+            '<guid>{1}/post/{0}</guid><pubDate>{2}</pubDate></item>'
+            '</channel></rss>').format(index, base, formatdate()).encode()
+
+
+class Fixtures:
+    def __init__(self, latency=0.0, jitter=0.0, fail_rate=0.0, filler=50, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.fail_rate = fail_rate
+        self.filler = filler
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+        self.bytes_sent = 0
+
+    def body(self, path, base):
+        kind, _, name = path.strip('/').partition('/')
+        index = name.split('.')[0]
+        if not index.isdigit():
+            return kind, None
+        index = int(index)
+        if kind == 'feed':
+            return kind, make_feed(index, base)
+        elif kind in ('post', 'page'):
+            return kind, make_page(index, self.filler)
+        elif kind == 'files':
+            return kind, make_puzzle(index)
+        return kind, None
+
+    def handler(self):
+        fixtures = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def respond(self, send_body):
+                with fixtures.lock:
+                    delay = fixtures.latency + fixtures.random.random() * fixtures.jitter
+                    failed = fixtures.random.random() < fixtures.fail_rate
+                time.sleep(delay)
+
+                base = 'http://{}:{}'.format(*self.server.server_address)
+                kind, body = fixtures.body(self.path.split('?')[0], base)
+
+                if failed:
+                    status, body = 503, b'injected failure'
+                elif body is None:
+                    status, body = 404, b'not found'
+                else:
+                    status = 200
+
+                etag = '"{}"'.format(hash(body))
+                if status == 200 and self.headers.get('If-None-Match') == etag:
+                    status, body = 304, b''
+
+                with fixtures.lock:
+                    fixtures.counts[(self.command, kind, status)] += 1
+                    if send_body:
+                        fixtures.bytes_sent += len(body)
+
+                self.send_response(status)
+                if status in (200, 304):
+                    self.send_header('ETag', etag)
+                content_type = {'feed': 'application/rss+xml',
+                                'post': 'text/html; charset=utf-8',
+                                'page': 'text/html; charset=utf-8'
+                                }.get(kind, 'application/octet-stream')
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if send_body:
+                    self.wfile.write(body)
+
+            def do_GET(self):
+                self.respond(True)
+
+            def do_HEAD(self):
+                self.respond(False)
+
+        return Handler
+
+    def serve(self, hosts):
+        servers = []
+        for n in range(hosts):
+            server = http.server.ThreadingHTTPServer(
+                    ('127.0.0.{}'.format(n + 1), 0), self.handler())
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            servers.append(server)
+        return servers
+
+
+class FakeIMAP:
+    # Just enough of IMAPClient for scan_inbox: one message per email source,
+    # each carrying a .puz attachment as its second MIME part.
+    def __init__(self, messages):
+        self.messages = messages
+        self.calls = collections.Counter()
+
+    def login(self, *args):
+        self.calls['login'] += 1
+
+    def select_folder(self, *args):
+        self.calls['select_folder'] += 1
+        return {b'UIDVALIDITY': 1}
+
+    def search(self, criteria):
+        self.calls['search'] += 1
+        senders = [criteria[i + 1] for i, c in enumerate(criteria) if c == 'FROM']
+        return [uid for uid, (address, _) in self.messages.items()
+                if address in senders]
+
+    def fetch(self, uids, items):
+        self.calls['fetch'] += 1
+        response = {}
+        for uid in uids:
+            address, payload = self.messages[uid]
+            mailbox, host = address.split('@')
+            if 'ENVELOPE' in items:
+                structure = parse_fetch_response([
+                    '1 (UID {} BODYSTRUCTURE (("TEXT" "PLAIN" ("CHARSET" "utf-8") '
+                    'NIL NIL "7BIT" 10 1 NIL NIL NIL NIL)("APPLICATION" "OCTET-STREAM" '
+                    '("NAME" "mail{}.puz") NIL NIL "BASE64" {} NIL ("ATTACHMENT" NIL) '
+                    'NIL NIL) "MIXED" ("BOUNDARY" "b") NIL NIL NIL))'.format(
+                        uid, uid, len(payload)).encode()], True)[uid][b'BODYSTRUCTURE']
+                envelope = Envelope(None, 'Puzzle {}'.format(uid).encode(),
+                                    (Address(b'Source', None, mailbox.encode(),
+                                             host.encode()),),
+                                    None, None, None, None, None, None, None)
+                response[uid] = {b'ENVELOPE': envelope, b'BODYSTRUCTURE': structure}
+            else:
+                response[uid] = {b'BODY[2]': base64.b64encode(payload)}
+        return response
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+class FakeWorksheet:
+    def __init__(self, title):
+        self.title = title
+
+
+class FakeSpreadsheet:
+    id = 'synthetic-sources'
+
+    def __init__(self, worksheets, calls):
+        self.worksheets_values = worksheets
+        self.calls = calls
+
+    def worksheets(self):
+        self.calls['worksheets'] += 1
+        return [FakeWorksheet(title) for title in self.worksheets_values]
+
+    def values_batch_get(self, ranges):
+        self.calls['values_batch_get'] += 1
+        return {'valueRanges': [{'values': values} for values
+                                in self.worksheets_values.values()]}
+
+
+class FakeGspread:
+    def __init__(self, worksheets):
+        self.worksheets = worksheets
+        self.calls = collections.Counter()
+
+    def open(self, title):
+        self.calls['open'] += 1
+        return FakeSpreadsheet(self.worksheets, self.calls)
+
+    def open_by_key(self, key):
+        return self.open(key)
+
+    def request(self, method, url, params=None):
+        self.calls['request'] += 1
+        return FakeResponse({'modifiedTime': '2000-01-01T00:00:00.000Z'})
+
+
+def build_sources(count, servers):
+    columns = ['Name', 'Homepage', 'RSS', 'Email address', 'Tech', 'Direct Link',
+               *WEEKDAYS, 'DOM', 'Bold', 'Normal', 'Italic',
+               'Expected author', 'Expected title']
+    rows = [columns]
+    messages = {}
+
+    for i in range(count):
+        if i and i % 10 == 0:
+            rows.append([''] * len(columns))
+
+        host, port = servers[i % len(servers)].server_address
+        base = 'http://{}:{}'.format(host, port)
+        site = dict.fromkeys(columns, '')
+        site.update({'Name': 'Source {}'.format(i), 'Homepage': base + '/',
+                     'Italic': 'Synthetic source'})
+        site.update(dict.fromkeys(WEEKDAYS, 'x'))
+
+        kind = ['rss', 'direct', 'page', 'email'][i % 4]
+        if kind == 'rss':
+            site['RSS'] = '{}/feed/{}.xml'.format(base, i)
+        elif kind == 'direct':
+            site['Tech'] = 'direct'
+            site['Direct Link'] = '{}/files/{}.puz'.format(base, i)
+        elif kind == 'page':
+            site['Tech'] = 'page'
+            site['Homepage'] = '{}/page/{}'.format(base, i)
+        else:
+            site['Email address'] = 'source{}@example.com'.format(i)
+            messages[i + 1] = (site['Email address'], make_puzzle(i))
+
+        rows.append([site[c] for c in columns])
+
+    return {
+        'Puzzle sources': rows,
+        'Post-script': [['Synthetic run.']],
+        'Other American': [['Name', 'Link', 'Comment'], ['Elsewhere', 'https://example.com', '']],
+        'Other Cryptic/Variety': [['Name', 'Link', 'Comment']],
+        'Reminder': [['DOM', 'Text']],
+        }, messages
+
+
+class StageTimer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = collections.Counter()
+        self.calls = collections.Counter()
+
+    def wrap(self, name, func):
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.totals[name] += time.perf_counter() - start
+                    self.calls[name] += 1
+        return timed
+
+    @contextlib.contextmanager
+    def installed(self):
+        originals = {name: getattr(automatt, name) for name in STAGES}
+        for name, func in originals.items():
+            setattr(automatt, name, self.wrap(name, func))
+        try:
+            yield
+        finally:
+            for name, func in originals.items():
+                setattr(automatt, name, func)
+
+
+def run_once(workdir, config, gspread_stub, imap_stub, trace_memory):
+    timer = StageTimer()
+    service_account = gspread.service_account
+    imap_client = imapclient.IMAPClient
+    gspread.service_account = lambda *args, **kwargs: gspread_stub
+    imapclient.IMAPClient = lambda *args, **kwargs: imap_stub
+    automatt.sheets_client.cache_clear()
+
+    config_path = os.path.join(workdir, 'email.yaml')
+    with open(config_path, 'w') as f:
+        yaml.safe_dump(config, f)
+    os.environ['CONFIG_PATH'] = config_path
+
+    cwd = os.getcwd()
+    output = io.StringIO()
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        with timer.installed(), contextlib.redirect_stdout(output):
+            automatt.main(['-d'])
+    finally:
+        wall = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        if trace_memory:
+            tracemalloc.stop()
+        os.chdir(cwd)
+        gspread.service_account = service_account
+        imapclient.IMAPClient = imap_client
+
+    return wall, peak, timer, output.getvalue()
+
+
+def report(label, wall, peak, timer, fixtures, gspread_stub, imap_stub, before):
+    counts = fixtures.counts - before
+    print('== {} =='.format(label))
+    print('wall time        {:8.2f}s'.format(wall))
+    print('http requests    {:8d}'.format(sum(counts.values())))
+    by_kind = collections.Counter()
+    for (method, kind, status), n in counts.items():
+        by_kind['{} {} {}'.format(method, kind, status)] += n
+    for key, n in sorted(by_kind.items()):
+        print('    {:<24} {:6d}'.format(key, n))
+    print('imap calls       {}'.format(dict(imap_stub.calls)))
+    print('sheets calls     {}'.format(dict(gspread_stub.calls)))
+    print('max rss          {:8.1f} MB'.format(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+    if peak is not None:
+        print('traced peak      {:8.1f} MB'.format(peak / 1024 / 1024))
+    print('stage timings (summed across threads)')
+    for name in STAGES:
+        if timer.calls[name]:
+            print('    {:<24} {:6d} calls {:9.3f}s'.format(
+                name, timer.calls[name], timer.totals[name]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sources', type=int, default=100)
+    parser.add_argument('--hosts', type=int, default=8,
+                        help='number of simulated hosts the sources are spread over')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='extra random latency, up to this many seconds')
+    parser.add_argument('--fail-rate', type=float, default=0.0,
+                        help='fraction of requests answered with a 503')
+    parser.add_argument('--filler', type=int, default=50,
+                        help='comment blocks padding each post and page')
+    parser.add_argument('--runs', type=int, default=2,
+                        help='runs against the same cache, the first one cold')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='measure peak Python allocations with tracemalloc (slower)')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help='override an email.yaml setting, e.g. --set workers=16')
+    parser.add_argument('--keep', action='store_true',
+                        help="keep the working directory and print the last run's output")
+    args = parser.parse_args()
+
+    fixtures = Fixtures(latency=args.latency, jitter=args.jitter,
+                        fail_rate=args.fail_rate, filler=args.filler)
+    servers = fixtures.serve(args.hosts)
+    worksheets, messages = build_sources(args.sources, servers)
+
+    workdir = tempfile.mkdtemp(prefix='automatt-bench-')
+    config = {
+        'from_address': {'automatt@example.com': 'Automatt'},
+        'password': 'unused',
+        'recipients': ['nobody@example.com'],
+        'message': 'Found {puzcount} puzzles in {entrycount} entries.',
+        'subject': 'Automatt %Y-%m-%d',
+        'imap_server': 'imap.invalid',
+        'output_dir': os.path.join(workdir, 'output'),
+        'cache_dir': os.path.join(workdir, 'cache'),
+        }
+    for setting in args.set:
+        key, _, value = setting.partition('=')
+        config[key] = yaml.safe_load(value)
+    os.makedirs(config['output_dir'])
+
+    try:
+        for run in range(args.runs):
+            gspread_stub = FakeGspread(worksheets)
+            imap_stub = FakeIMAP(messages)
+            before = collections.Counter(fixtures.counts)
+            wall, peak, timer, output = run_once(workdir, config, gspread_stub,
+                                                 imap_stub, args.trace_memory)
+            report('run {} ({})'.format(run + 1, 'cold' if run == 0 else 'warm'),
+                   wall, peak, timer, fixtures, gspread_stub, imap_stub, before)
+        if args.keep:
+            print(output)
+            print('working directory:', workdir)
+    finally:
+        for server in servers:
+            server.shutdown()
+        if not args.keep:
+            shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
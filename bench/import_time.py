@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+# Import-time budget for automatt.
+#
+#     python bench/import_time.py            # check against import_budget.json
+#     python bench/import_time.py --update   # re-baseline the budget
+#
+# Each scenario runs in a fresh interpreter under `python -X importtime`, and
+# only the imports beyond a bare interpreter's startup are counted. A
+# scenario fails if its time goes over its budget or if it loads a module it
+# shouldn't need at all. Budgets are multiples of the time taken by
+# `import requests`, which automatt can't do without, measured in the same
+# way on the same machine, so that they hold on a faster or slower one. The
+# reference and the scenarios are run in turn, round after round, and each
+# is timed by its fastest run, which is the one least disturbed by whatever
+# else the machine was doing.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+BUDGET_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'import_budget.json')
+
+REFERENCE = 'import requests'
+
+HEAVY = ['gspread', 'yagmail', 'xword_dl', 'bs4', 'feedparser', 'imapclient',
+         'puz', 'titlecase', 'yaml', 'discord']
+
+SCENARIOS = {
+    'import': {
+        'code': 'import automatt',
+        'forbidden': HEAVY,
+        },
+    'render': {
+        'code': ('import automatt; '
+                 "automatt.format_string('%sitename %Y-%m-%d', {'name': 'x'}); "
+                 'automatt.create_html_list([]); automatt.create_csv([])'),
+        'forbidden': HEAVY,
+        },
+    'dry run options': {
+        'code': "import automatt; automatt.parse_args(['-d', '--retry-failed'])",
+        'forbidden': HEAVY,
+        },
+    'xword-dl worker': {
+        'code': 'import automatt, xword_dl',
+        'forbidden': ['gspread', 'yagmail', 'imapclient', 'discord'],
+        },
+    }
+
+
+def import_times(code):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            cwd=BASE_DIR, capture_output=True, text=True)
+    if result.returncode:
+        sys.exit('{!r} failed:\n{}'.format(code, result.stderr))
+
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        # nested imports are indented by two spaces per level
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        times[name.strip()] = (int(own), int(cumulative), depth)
+    return times
+
+
+def measure(code, baseline):
+    times = import_times(code)
+    added = {name: t for name, t in times.items() if name not in baseline}
+    top_level = sorted(((cumulative, name) for name, (own, cumulative, depth)
+                        in added.items() if depth == 0), reverse=True)
+    return sum(own for own, _, _ in added.values()) / 1000, set(added), top_level
+
+
+def measure_all(baseline, runs):
+    codes = {name: scenario['code'] for name, scenario in SCENARIOS.items()}
+    codes[REFERENCE] = REFERENCE
+
+    # one untimed round first, so the first scenario isn't the one that
+    # warms the filesystem cache
+    for code in codes.values():
+        import_times(code)
+
+    fastest = {}
+    for _ in range(runs):
+        for name, code in codes.items():
+            result = measure(code, baseline)
+            if name not in fastest or result[0] < fastest[name][0]:
+                fastest[name] = result
+    return fastest
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=7)
+    parser.add_argument('--update', action='store_true',
+                        help='write the current ratios, plus headroom, as the new budget')
+    parser.add_argument('--headroom', type=float, default=1.5)
+    args = parser.parse_args()
+
+    baseline = set(import_times('pass'))
+    fastest = measure_all(baseline, args.runs)
+    reference = fastest[REFERENCE][0]
+    print('{:<18} {:8.1f}ms'.format(REFERENCE, reference))
+
+    try:
+        with open(BUDGET_PATH) as f:
+            budget = json.load(f)
+    except OSError:
+        budget = {}
+
+    failures = []
+    for name, scenario in SCENARIOS.items():
+        elapsed, modules, top_level = fastest[name]
+        ratio = elapsed / reference
+        limit = budget.get(name)
+
+        print('{:<18} {:8.1f}ms  {:5.2f}x  (budget {})'.format(
+            name, elapsed, ratio, '{}x'.format(limit) if limit else 'none'))
+        for cumulative, module in top_level[:5]:
+            print('    {:<30} {:8.1f}ms'.format(module, cumulative / 1000))
+
+        loaded = sorted(m for m in scenario['forbidden'] if m in modules)
+        if loaded:
+            failures.append('{} loads {}'.format(name, ', '.join(loaded)))
+        if args.update:
+            budget[name] = round(ratio * args.headroom, 2)
+        elif limit and ratio > limit:
+            failures.append('{} takes {:.2f}x as long as {}, over its {}x budget'.format(
+                name, ratio, REFERENCE, limit))
+
+    if args.update:
+        with open(BUDGET_PATH, 'w') as f:
+            json.dump(budget, f, indent=4)
+            f.write('\n')
+        print('budget written to', BUDGET_PATH)
+
+    if failures:
+        sys.exit('\n'.join(failures))
+
+
+if __name__ == '__main__':
+    main()
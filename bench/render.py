@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+# Microbenchmark for the template and HTML/CSV rendering path.
+#
+#     python bench/render.py --rows 1000 5000 20000
+#
+# Each size is rendered with the current code and with the string-replace
+# implementation it replaced, and the two outputs are compared byte for byte.
+# The one place they differ on purpose is a record value that itself looks
+# like a token, such as a link with %B or %d URL-encoded in it: the chain of
+# replaces went on to expand those, while a single pass leaves values as they
+# are. The synthetic records avoid such values, and that case is checked on
+# its own instead.
+
+import argparse
+import csv
+import io
+import os
+import random
+import sys
+import time
+
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import automatt
+
+
+def legacy_format_string(template, record={}):
+    tokens = {
+        '%link': record.get('link') or record.get('homepage',''),
+        '%homepage': record.get('homepage') or '',
+        '%sitename': record.get('name') or '',
+        '%pagetitle': record.get('pagetitle') or '%puztitle',
+        '%author': record.get('author') or record.get('expected_author') or 'tktktk',
+        '%puztitle': record.get('title') or record.get('expected_title') or 'tktktk',
+        '%blank': ''
+        }
+
+    supported_date_tokens = ['d','-d','m','-m','y','Y','B']
+
+    for t in ['%yest' + dt for dt in supported_date_tokens]:
+        yesterday = automatt.RUN_DATE - timedelta(1)
+        tokens[t] = yesterday.strftime(t.replace('yest',''))
+
+    for t in ['%' + dt for dt in supported_date_tokens]:
+        tokens[t] = automatt.RUN_DATE.strftime(t)
+
+    for token in tokens:
+        template = template.replace(token, tokens[token])
+
+    return template
+
+
+def legacy_create_html_list(records):
+    indent = "    "
+
+    html_list = automatt.HTML_HEADER.format(
+            automatt.RUN_DATE.strftime('%A, %B %-d, %Y'))
+
+    for rec in records:
+        template = rec.get('template') or ''
+
+        rec['formatted'] = legacy_format_string(template, rec)
+
+        if rec.get('puzfile'):
+            cls = 'fetched'
+        else:
+            cls = 'unfetched'
+
+        if rec['formatted']:
+
+            html_list += 3 * indent + '<span class="{}">'.format(cls)
+            html_list += "{}</span><br />\n".format(rec.get('formatted'))
+
+        elif not any(rec[key] for key in rec.keys()):
+            html_list += 2 * indent + "</p>\n" + 2 * indent + "<p>\n"
+
+    html_list += 2 * indent + "</p>\n"
+
+    return html_list
+
+
+def legacy_create_csv(records):
+    f = io.StringIO()
+    fields = ['name', 'title', 'author', 'expected_title', 'expected_author',
+              'link', 'puzfile', 'formatted', 'problem']
+    writer = csv.DictWriter(f, fields, extrasaction='ignore')
+    writer.writeheader()
+    for row in records:
+        writer.writerow(row)
+    return f.getvalue()
+
+
+TEMPLATES = [
+    '<strong><a href="%link">%sitename</a>: %puztitle</strong> by %author. <em>tktktk</em>',
+    '<strong>%sitename</strong> <a href="%link">%pagetitle</a> by %author. <em>%B %-d</em>',
+    '<strong>Weekly</strong> <a href="%homepage/%Y/%m/%d/">%puztitle</a>%blank <em>%yestB %yest-d, %yestY</em>',
+    ]
+
+
+def synthetic_records(rows, seed=0):
+    rng = random.Random(seed)
+    records = []
+    for i in range(rows):
+        if rng.random() < 0.05:
+            records.append({})
+            continue
+        records.append({
+            'name': 'Source {}'.format(i),
+            'homepage': 'https://example.com/{}'.format(i),
+            'link': rng.choice(['', 'https://example.com/{}/puzzle'.format(i)]),
+            'title': rng.choice(['', 'Puzzle No. {}'.format(i)]),
+            'pagetitle': rng.choice(['', 'Post {}'.format(i)]),
+            'author': rng.choice(['', 'Constructor {}'.format(i)]),
+            'expected_author': rng.choice(['', 'Someone']),
+            'expected_title': '',
+            'puzfile': rng.choice(['', 'p{}.puz'.format(i)]),
+            'problem': '',
+            'template': rng.choice(TEMPLATES),
+            })
+    return records
+
+
+# values the string-replace chain would have expanded a second time
+TOKEN_LIKE = {
+    'link': 'https://example.com/search?q=caf%C3%A9%20%B1%d2',
+    'name': 'The %sitename',
+    'title': '100%Y',
+    }
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 5000, 20000])
+    args = parser.parse_args()
+
+    automatt.RUN_DATE = datetime.today()
+
+    formatted = automatt.format_string('%link %sitename %puztitle', TOKEN_LIKE)
+    if formatted != '{link} {name} {title}'.format(**TOKEN_LIKE):
+        sys.exit('record values were expanded as tokens: {}'.format(formatted))
+
+    print('{:>8}  {:>12}  {:>12}  {:>12}  {:>12}'.format(
+        'rows', 'legacy html', 'html', 'legacy csv', 'csv'))
+
+    for rows in args.rows:
+        legacy_records = synthetic_records(rows)
+        records = synthetic_records(rows)
+
+        legacy_html_time, legacy_html = timed(legacy_create_html_list, legacy_records)
+        html_time, html = timed(automatt.create_html_list, records)
+        legacy_csv_time, legacy_csv = timed(legacy_create_csv, legacy_records)
+        csv_time, csv_out = timed(automatt.create_csv, records)
+
+        if html != legacy_html or csv_out != legacy_csv:
+            sys.exit('output differs from the legacy renderer at {} rows'.format(rows))
+
+        print('{:>8}  {:>11.1f}ms  {:>11.1f}ms  {:>11.1f}ms  {:>11.1f}ms'.format(
+            rows, legacy_html_time * 1000, html_time * 1000,
+            legacy_csv_time * 1000, csv_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,12 +6,17 @@ import os
 import pathlib
 import shlex
 import subprocess
+import sys
+import time
 
 import discord
-import xword_dl
 import yaml
 
 from discord.ext import commands
+from worker import BASE_DIR, PipelineWorker
+
+sys.path.insert(0, str(BASE_DIR))
+import automatt
 
 CONFIG_PATH = os.getenv("CONFIG_PATH") or pathlib.Path(__file__).parent.parent / "email.yaml"
 
@@ -24,6 +29,20 @@ GUILD_ID = config['discord_guild_id']
 command_string = config['run_command']
 command = shlex.split(command_string)
 
+# the worker calls automatt.main directly, with whatever options follow the
+# script in run_command; the command itself is the fallback if it can't
+script = next((i for i, arg in enumerate(command) if arg.endswith('.py')), len(command))
+base_args = command[script + 1:]
+worker = PipelineWorker([*command[:script + 1]], CONFIG_PATH,
+                        enabled=config.get('bot_worker', True))
+
+# scrapes run in their own processes, so a hung one can be killed without
+# taking the bot with it
+xword_pool = automatt.XwordPool(size=config.get('xword_workers', 2),
+                                timeout=config.get('xword_timeout', 60),
+                                memory_mb=config.get('xword_memory_mb', 1024))
+xword_pool.warm()
+
 guild = discord.Object(id=GUILD_ID)
 
 intents = discord.Intents.default()
@@ -33,21 +52,72 @@ intents.message_content = True
 
 bot = commands.Bot(command_prefix='!', intents=intents)
 
+class Progress:
+    def __init__(self, interaction, intro, every=5):
+        self.interaction = interaction
+        self.intro = intro
+        self.every = every
+        self.last = 0
+        self.found = 0
+        self.failed = []
+
+    async def __call__(self, event):
+        self.found += event['found']
+        if event['problems']:
+            self.failed.append(event['site'])
+
+        now = time.monotonic()
+        if now - self.last < self.every and event['done'] < event['total']:
+            return
+        self.last = now
+
+        status = f"{self.intro}\nchecked {event['done']} of {event['total']} sources, {self.found} with puzzles so far."
+        if self.failed:
+            status += f"\nhaving trouble with: {', '.join(self.failed)}"
+        await self.interaction.edit_original_response(content=status)
+
+async def run_job(interaction, args, intro):
+    progress = Progress(interaction, intro)
+    job, duplicate = worker.submit(args, progress)
+
+    if duplicate:
+        intro = "that's already queued up, I'll let you know when it's done."
+    elif worker.pending() > 1:
+        intro += f" (queued behind {worker.pending() - 1} other run{'s' if worker.pending() > 2 else ''})"
+    progress.intro = intro
+    await interaction.response.send_message(intro)
+
+    result = await job.future
+
+    response = "alright, i tried!"
+    if result['errors']:
+        response += f" heads up, I did hit this error: {result['errors']}"
+    for name, delivery in result['deliveries'].items():
+        if delivery['ok']:
+            response += f"\n{name}: sent in {delivery['seconds']}s"
+        else:
+            response += f"\n{name}: didn't go out after {delivery['seconds']}s ({delivery['error']})"
+    await interaction.followup.send(response)
+
 @bot.tree.command(name="rerun",
                   description="Run the daily check again",
                   guild=guild)
 async def rerun(interaction):
-    await interaction.response.send_message("oops! re-running now. that usually takes about 10 minutes. go grab a coffee and I'll be here when you get back. ☕")
+    await run_job(interaction, base_args,
+                  "oops! re-running now. that usually takes about 10 minutes. go grab a coffee and I'll be here when you get back. ☕")
 
-    proc = await asyncio.create_subprocess_exec(*command,
-                                                stderr=asyncio.subprocess.PIPE)
-    stdout, stderr = await proc.communicate()
-    errors = stderr.decode().strip()
+@bot.tree.command(name="retry",
+                  description="Check again only the sources that failed today",
+                  guild=guild)
+async def retry(interaction, sites: str = ""):
+    names = [name.strip() for name in sites.split(",") if name.strip()]
 
-    response = "alright, i tried!"
-    if errors:
-        response += f" heads up, I did hit this error: {errors}"
-    await interaction.followup.send(response)
+    if names:
+        await run_job(interaction, [*base_args, "--sites", *names],
+                      f"on it, checking {', '.join(names)} again.")
+    else:
+        await run_job(interaction, [*base_args, "--retry-failed"],
+                      "on it, checking the sources that failed earlier today.")
 
 @bot.tree.command(name="scrape",
                   description="try to scrape a given URL with xword-dl",
@@ -57,14 +127,17 @@ async def scrape(interaction, url: str):
         await interaction.response.send_message("No URL provided")
         return
 
+    await interaction.response.defer(thinking=True)
+
     try:
-        puzzle, filename = xword_dl.by_url(url)
+        data, filename = await asyncio.get_running_loop().run_in_executor(
+                None, xword_pool.by_url, url)
     except Exception as e:
-        await interaction.response.send_message(f"Unable to scrape {url}, sorry! Error: {e}")
+        await interaction.followup.send(f"Unable to scrape {url}, sorry! Error: {e}")
         return
 
-    file = discord.File(io.BytesIO(puzzle.tobytes()), filename=filename)
-    await interaction.response.send_message(content=f"Here's the puzzle from {url}", file=file)
+    file = discord.File(io.BytesIO(data), filename=filename)
+    await interaction.followup.send(content=f"Here's the puzzle from {url}", file=file)
 
 @bot.command()
 @commands.is_owner()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+# A long-lived automatt process for the bot. Run as a script, it imports
+# automatt once and then takes jobs as JSON lines on stdin, answering with
+# JSON lines on stdout; automatt's own output goes to stderr. Imported, it
+# provides PipelineWorker, which queues jobs for that process from the bot.
+
+import asyncio
+import itertools
+import json
+import os
+import pathlib
+import sys
+import threading
+
+BASE_DIR = pathlib.Path(__file__).parent.parent
+
+
+def serve():
+    protocol = sys.stdout
+    sys.stdout = sys.stderr
+
+    sys.path.insert(0, str(BASE_DIR))
+    import automatt
+
+    lock = threading.Lock()
+
+    def send(**event):
+        with lock:
+            protocol.write(json.dumps(event) + '\n')
+            protocol.flush()
+
+    send(event='ready')
+
+    for line in sys.stdin:
+        job = json.loads(line)
+        progress = lambda update: send(event='progress', job=job['id'], update=update)
+        try:
+            message, deliveries = automatt.main(job['argv'], progress=progress)
+        except (Exception, SystemExit) as e:
+            send(event='done', job=job['id'],
+                 result={'message': '', 'errors': repr(e), 'deliveries': {}})
+        else:
+            send(event='done', job=job['id'],
+                 result={'message': message, 'errors': '', 'deliveries': deliveries})
+
+
+class Job:
+    def __init__(self, job_id, argv):
+        self.id = job_id
+        self.argv = argv
+        self.listeners = []
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class PipelineWorker:
+    def __init__(self, command, config_path, enabled=True):
+        # command is what runs automatt.py; its interpreter runs the worker
+        self.command = command
+        self.python = command[:-1] or [sys.executable]
+        self.config_path = config_path
+        self.enabled = enabled
+        self.ids = itertools.count(1)
+        self.queue = asyncio.Queue()
+        self.queued = {}
+        self.runner = None
+        self.process = None
+
+    def submit(self, argv, listener=None):
+        # an identical job that hasn't started yet is shared rather than
+        # queued twice; one that is already running gets a new job, since
+        # whatever prompted the request may have changed since it started
+        key = tuple(argv)
+        job = self.queued.get(key)
+        duplicate = job is not None
+
+        if not duplicate:
+            job = self.queued[key] = Job(next(self.ids), list(argv))
+            self.queue.put_nowait(job)
+
+        if listener:
+            job.listeners.append(listener)
+
+        if self.runner is None:
+            self.runner = asyncio.create_task(self.run())
+
+        return job, duplicate
+
+    def pending(self):
+        return self.queue.qsize()
+
+    async def run(self):
+        while True:
+            job = await self.queue.get()
+            del self.queued[tuple(job.argv)]
+
+            try:
+                result = None
+                if self.enabled:
+                    try:
+                        result = await self.run_in_worker(job)
+                    except (EOFError, OSError, ValueError) as e:
+                        print('automatt worker failed, falling back to a subprocess:', repr(e))
+                        await self.stop()
+                if result is None:
+                    result = await self.run_in_subprocess(job)
+                job.future.set_result(result)
+            except Exception as e:
+                job.future.set_exception(e)
+
+    async def send(self, message):
+        self.process.stdin.write((json.dumps(message) + '\n').encode())
+        await self.process.stdin.drain()
+
+    async def recv(self):
+        line = await self.process.stdout.readline()
+        if not line:
+            raise EOFError('the worker exited with {}'.format(await self.process.wait()))
+        return json.loads(line)
+
+    async def start(self):
+        env = dict(os.environ, CONFIG_PATH=str(self.config_path))
+        self.process = await asyncio.create_subprocess_exec(
+                *self.python, __file__, env=env, limit=2 ** 24,
+                stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
+
+        if (await self.recv()).get('event') != 'ready':
+            raise OSError('the worker did not start')
+
+    async def stop(self):
+        if not self.process:
+            return
+
+        process, self.process = self.process, None
+        if process.returncode is None:
+            try:
+                process.stdin.close()
+                await asyncio.wait_for(process.wait(), 10)
+            except (OSError, asyncio.TimeoutError):
+                process.kill()
+                await process.wait()
+
+    async def run_in_worker(self, job):
+        if not self.process or self.process.returncode is not None:
+            await self.start()
+
+        await self.send({'id': job.id, 'argv': job.argv})
+
+        while True:
+            message = await self.recv()
+            if message.get('job') != job.id:
+                continue
+            if message['event'] == 'progress':
+                await self.notify(job, message['update'])
+            elif message['event'] == 'done':
+                return message['result']
+
+    async def run_in_subprocess(self, job):
+        proc = await asyncio.create_subprocess_exec(*self.command, *job.argv,
+                                                    stderr=asyncio.subprocess.PIPE)
+        stdout, stderr = await proc.communicate()
+        return {'message': '', 'errors': stderr.decode().strip(), 'deliveries': {}}
+
+    async def notify(self, job, update):
+        for listener in job.listeners:
+            try:
+                await listener(update)
+            except Exception as e:
+                print('could not report progress:', repr(e))
+
+
+if __name__ == '__main__':
+    serve()
@@ -0,0 +1,37 @@
+import pytest
+
+import automatt
+
+
+CANDIDATES = ['https://example.com/a.puz', 'https://example.com/b.puz']
+
+
+@pytest.fixture
+def negative_cache(monkeypatch):
+    cache = automatt.NegativeCache()
+    monkeypatch.setattr(automatt, 'negative_cache', cache)
+    monkeypatch.setattr(automatt, 'get_possible_puzfiles', lambda link, fresh=False: CANDIDATES)
+    return cache
+
+
+def test_a_deadline_while_probing_caches_nothing(negative_cache, monkeypatch):
+    def probe_candidate(url, fresh=False):
+        raise automatt.DeadlineExceeded('ran past its deadline')
+
+    monkeypatch.setattr(automatt, 'probe_candidate', probe_candidate)
+
+    with pytest.raises(automatt.DeadlineExceeded):
+        automatt.handle_page('https://example.com/post')
+    assert not negative_cache.data
+
+
+def test_a_failed_download_caches_nothing(negative_cache, monkeypatch):
+    def handle_direct_download(url, fresh=False):
+        raise Exception('Download at {} is over the limit'.format(url))
+
+    monkeypatch.setattr(automatt, 'probe_candidate', lambda url, fresh=False: True)
+    monkeypatch.setattr(automatt, 'handle_direct_download', handle_direct_download)
+    monkeypatch.setattr(automatt, 'page_via_xword_dl', lambda link: '')
+
+    assert automatt.handle_page('https://example.com/post') == ''
+    assert not negative_cache.data
@@ -0,0 +1,14 @@
+import automatt
+
+
+def test_configuring_again_keeps_the_pooled_connections():
+    client = automatt.HTTPClient()
+    client.configure(retries=2, backoff_factor=0.5, pool_size=4)
+    adapter = client.session.get_adapter('https://example.com/')
+
+    client.configure(retries=2, backoff_factor=0.5, pool_size=4)
+    assert client.session.get_adapter('https://example.com/') is adapter
+
+    client.configure(retries=1, backoff_factor=0.5, pool_size=4)
+    assert client.session.get_adapter('https://example.com/') is not adapter
+    assert client.session.get_adapter('https://example.com/').max_retries.total == 1
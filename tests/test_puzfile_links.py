@@ -0,0 +1,42 @@
+import json
+import pathlib
+
+import pytest
+
+import automatt
+
+PAGES = pathlib.Path(__file__).parent / 'fixtures' / 'pages'
+
+# the expected candidates are what the BeautifulSoup version of
+# get_possible_puzfiles found in each page, in the order it found them
+EXPECTED = json.loads((PAGES / 'expected.json').read_text())
+
+
+@pytest.mark.parametrize('name', sorted(EXPECTED))
+def test_candidates_match_beautifulsoup(name):
+    html = (PAGES / (name + '.html')).read_text()
+    expected = EXPECTED[name]
+
+    assert automatt.extract_puzfile_links(html, expected['url']) == expected['candidates']
+
+
+def test_every_fixture_has_expectations():
+    assert {path.stem for path in PAGES.glob('*.html')} == set(EXPECTED)
+
+
+def test_crosshare_iframes_come_first_last_one_leading():
+    html = (PAGES / 'crosshare-iframe.html').read_text()
+
+    assert automatt.extract_puzfile_links(html, 'https://example.com/') == [
+        'https://crosshare.org/api/puz/ZZZ999',
+        'https://crosshare.org/api/puz/AbC123xyz',
+        'https://example.org/uploads/themeless.puz',
+        ]
+
+
+def test_litsoft_links_are_skipped():
+    html = (PAGES / 'litsoft.html').read_text()
+
+    assert automatt.extract_puzfile_links(html, 'https://example.com/a/') == [
+        'https://example.com/a/puzzles/week42.puz',
+        ]
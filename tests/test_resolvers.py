@@ -0,0 +1,63 @@
+import pytest
+
+import automatt
+
+
+@pytest.mark.parametrize('url, expected', [
+    ('https://drive.google.com/file/d/1AbC-dEf_123/view?usp=sharing',
+     'https://drive.google.com/uc?export=download&id=1AbC-dEf_123'),
+    ('https://drive.google.com/file/d/1AbC-dEf_123',
+     'https://drive.google.com/uc?export=download&id=1AbC-dEf_123'),
+    ('https://drive.google.com/file/d/1AbC-dEf_123#heading',
+     'https://drive.google.com/uc?export=download&id=1AbC-dEf_123'),
+    ])
+def test_google_drive(url, expected):
+    assert automatt.resolve_url(url) == expected
+
+
+def test_google_drive_folders_are_left_alone():
+    assert automatt.resolve_url('https://drive.google.com/drive/folders/1xyz') is None
+
+
+@pytest.mark.parametrize('url, expected', [
+    ('https://www.dropbox.com/s/abc123/puzzle.puz',
+     'https://www.dropbox.com/s/abc123/puzzle.puz?dl=1'),
+    ('https://www.dropbox.com/scl/fi/abc123/puzzle.puz?rlkey=xyz',
+     'https://www.dropbox.com/scl/fi/abc123/puzzle.puz?rlkey=xyz&dl=1'),
+    ])
+def test_dropbox(url, expected):
+    assert automatt.resolve_url(url) == expected
+
+
+def test_dropbox_download_links_pass_through():
+    assert automatt.resolve_url('https://www.dropbox.com/s/abc123/puzzle.puz?dl=1') is None
+    assert automatt.resolve_url('https://www.dropbox.com/scl/fi/abc/p.puz?rlkey=x&dl=1') is None
+
+
+@pytest.mark.parametrize('url, expected', [
+    ('https://crosshare.org/crosswords/AbC123xyz/a-themeless',
+     'https://crosshare.org/api/puz/AbC123xyz'),
+    ('https://crosshare.org/crosswords/AbC123xyz',
+     'https://crosshare.org/api/puz/AbC123xyz'),
+    ('https://crosshare.org/embed/AbC123xyz/9sd8f7',
+     'https://crosshare.org/api/puz/AbC123xyz'),
+    ('https://crosshare.org/embed/AbC123xyz?color=blue',
+     'https://crosshare.org/api/puz/AbC123xyz'),
+    ])
+def test_crosshare(url, expected):
+    assert automatt.resolve_url(url) == expected
+
+
+def test_crosshare_download_urls_are_not_matched_again():
+    assert automatt.resolve_url('https://crosshare.org/api/puz/AbC123xyz') is None
+
+
+@pytest.mark.parametrize('url', [
+    'https://example.com/puzzles/today.puz',
+    'https://www.google.com/file/d/notdrive',
+    'https://crosshare.org/',
+    '',
+    ])
+def test_unknown_hosts(url):
+    assert automatt.resolve_url(url) is None
+
@@ -0,0 +1,51 @@
+import email.utils
+import hashlib
+import time
+
+import automatt
+
+
+class Response:
+    def __init__(self, content=b'', url=''):
+        self.content = content
+        self.url = url
+
+    def raise_for_status(self):
+        pass
+
+
+def feed(count):
+    published = email.utils.formatdate(time.time())
+    items = ''.join('''
+        <item>
+          <title>Puzzle {0}</title>
+          <link>https://example.com/post/{0}</link>
+          <guid>https://example.com/post/{0}</guid>
+          <pubDate>{1}</pubDate>
+        </item>'''.format(number, published) for number in range(count))
+    return '''<?xml version="1.0"?>
+        <rss version="2.0"><channel>
+          <title>Example</title>
+          <link>https://example.com/</link>
+          {}
+        </channel></rss>'''.format(items).encode()
+
+
+def test_every_new_post_gets_its_puzzle(tmp_path, monkeypatch):
+    def handle_page(link, fresh=False, key=None):
+        filename = link.split('/')[-1] + '.puz'
+        (tmp_path / filename).write_bytes(link.encode())
+        return filename
+
+    monkeypatch.setattr(automatt, 'DAY_DIR', str(tmp_path))
+    monkeypatch.setattr(automatt.http_client, 'get_cached', lambda url: Response(feed(3)))
+    monkeypatch.setattr(automatt.http_client, 'head',
+                        lambda url, **kwargs: Response(url=url))
+    monkeypatch.setattr(automatt, 'handle_page', handle_page)
+
+    records = automatt.handle_rss_feed({'Name': 'Example', 'RSS': 'https://example.com/feed'})
+
+    assert [rec['puzfile'] for rec in records] == ['0.puz', '1.puz', '2.puz']
+    assert [rec['sha256'] for rec in records] == [
+        hashlib.sha256('https://example.com/post/{}'.format(number).encode()).hexdigest()
+        for number in range(3)]